@@ -1,6 +1,8 @@
 import argparse
+import queue
 import time
 from pathlib import Path
+from threading import Thread
 
 import cv2
 import torch
@@ -8,14 +10,16 @@ import torch.backends.cudnn as cudnn
 from numpy import random
 
 from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from utils.datasets import LoadStreams, LoadImages, LoadImageBatches, VideoWriters
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
-    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path,non_max_suppression_MA
+    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path,non_max_suppression_MA, Diagnostics
 from utils.plots import plot_one_box
-from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
+from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel, InputStager
 
 import pdb
 
+diag = Diagnostics(__name__)
+
 
 def detect(save_img=False):
     source, weights, view_img, save_txt, imgsz, trace = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size, not opt.no_trace
@@ -28,13 +32,16 @@ def detect(save_img=False):
     (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
     # Initialize
-    set_logging()
+    set_logging(diagnostics=opt.diagnostics)
     device = select_device(opt.device)
     half = device.type != 'cpu'  # half precision only supported on CUDA
 
     # Load model
     model = attempt_load(weights, map_location=device)  # load FP32 model
     stride = int(model.stride[0].max())  # model stride
+    for m in model.modules():
+        if hasattr(m, 'lazy'):
+            m.lazy = True  # attribute heads keep raw outputs, NMS activates them at the surviving anchors only
     imgsz = check_img_size(imgsz, s=stride)  # check img_size
 
     # pdb.set_trace()
@@ -53,13 +60,18 @@ def detect(save_img=False):
         modelc.load_state_dict(torch.load('weights/resnet101.pt', map_location=device)['model']).to(device).eval()
 
     # Set Dataloader
-    vid_path, vid_writer = None, None
+    vid_writers = VideoWriters()  # video writer per save path
+    batched = webcam or opt.batch_size > 1  # dataset yields lists of paths, images and captures
     if webcam:
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, every=opt.stream_stride, latest=not opt.stream_fifo)
+    elif batched:
+        dataset = LoadImageBatches(source, img_size=imgsz, stride=stride, batch_size=opt.batch_size,
+                                   workers=opt.workers if opt.pipeline else 0, prefetch=opt.prefetch)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, workers=opt.workers if opt.pipeline else 0,
+                             prefetch=opt.prefetch)
 
     # Get names and colors
     names_classes_lis = model.module.names_classes_lis if hasattr(model, 'module') else model.names_classes_lis
@@ -72,61 +84,21 @@ def detect(save_img=False):
         model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
     old_img_w = old_img_h = imgsz
     old_img_b = 1
+    stager = InputStager(device, half)  # uint8 batches to normalized device inputs
 
-    t0 = time.time()
-    for path, img, im0s, vid_cap in dataset:
-        img = torch.from_numpy(img).to(device)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
-
-        # Warmup
-        if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
-            old_img_b = img.shape[0]
-            old_img_h = img.shape[2]
-            old_img_w = img.shape[3]
-            for i in range(3):
-                model(img, augment=opt.augment)[0]
-
-        # Inference
-        t1 = time_synchronized()
-        with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
-            pred,train_out=[],[]
-            out_total=model(img, augment=opt.augment)
-            for k in range(n_att):
-                each_out,each_train_out =out_total[k]  # inference and training outputs
-                pred.append(each_out)
-                #train_out.append(each_train_out)
-        t2 = time_synchronized()
-
-        # Apply NMS
-        #pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
-
-        
-        print("\npred before NMS_MA",len(pred),pred[1].size())
-        pred = non_max_suppression_MA(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
-        print("\npred after NMS_MA,",len(pred),len(pred[0]))
-        t3 = time_synchronized()
-
-        # Apply Classifier
-        if classify:
-            pred = apply_classifier(pred, modelc, img, im0s)
-
-        # Process detections
+    # Postprocess, render and write the detections of a batch
+    def process(paths, img_shape, im0s, pred, mode, descs, frames, videos, ended, t):
+        t1, t2, t3 = t
         for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
-            else:
-                p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
+            p, s, im0, frame = paths[i], descs[i], im0s[i], frames[i]
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # img.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # img.txt
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+                det[:, :4] = scale_coords(img_shape, det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, 5].unique():
@@ -156,29 +128,109 @@ def detect(save_img=False):
 
             # Save results (image with detections)
             if save_img:
-                if dataset.mode == 'image':
+                if mode == 'image':
                     cv2.imwrite(save_path, im0)
                     print(f" The image with the result is saved in: {save_path}")
                 else:  # 'video' or 'stream'
-                    if vid_path != save_path:  # new video
-                        vid_path = save_path
-                        if isinstance(vid_writer, cv2.VideoWriter):
-                            vid_writer.release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                            save_path += '.mp4'
-                        vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer.write(im0)
+                    vid_writers.write(save_path, im0, videos[i])
+
+        # Release writers of finished videos
+        if ended is None:  # videos that left the batches
+            vid_writers.release(set(vid_writers.writers) - {str(save_dir / Path(p).name) for p in paths})
+        else:  # streams that ended, a stream missing from this batch may only be late
+            vid_writers.release(str(save_dir / Path(p).name) for p in ended)
+
+    # Pipeline: frames decode ahead in the dataset threads, outputs are processed in order in a worker thread
+    jobs, errors = queue.Queue(opt.prefetch), []  # bounded, inference waits for the output stage
+
+    def work():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                if not errors:
+                    process(*job)
+            except Exception as e:
+                errors.append(e)
+
+    if opt.pipeline:
+        worker = Thread(target=work, daemon=True)
+        worker.start()
+
+    t0 = time.time()
+    for path, img, im0s, vid_cap in dataset:
+        img = stager(img)  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+        if img.ndimension() == 3:
+            img = img.unsqueeze(0)
+
+        # Warmup
+        if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
+            old_img_b = img.shape[0]
+            old_img_h = img.shape[2]
+            old_img_w = img.shape[3]
+            for i in range(3):
+                model(img, augment=opt.augment)[0]
+
+        # Inference
+        t1 = time_synchronized()
+        with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
+            pred,train_out=[],[]
+            out_total=model(img, augment=opt.augment)
+            for k in range(n_att):
+                each_out,each_train_out =out_total[k]  # inference and training outputs
+                pred.append(each_out)
+                #train_out.append(each_train_out)
+        t2 = time_synchronized()
+
+        # Apply NMS
+        #pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+
+        
+        pred = non_max_suppression_MA(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        diag.debug('NMS_MA: %g images, %g detections in the first', len(pred), len(pred[0]))
+        t3 = time_synchronized()
+
+        # Apply Classifier
+        if classify:
+            pred = apply_classifier(pred, modelc, img, im0s)
+
+        # Process detections
+        if batched:
+            descs, frames = dataset.desc, dataset.frames
+        else:
+            path, im0s, vid_cap, descs, frames = [path], [im0s], [vid_cap], [dataset.desc], [getattr(dataset, 'frame', 0)]
+        videos = [(c.get(cv2.CAP_PROP_FPS), int(c.get(cv2.CAP_PROP_FRAME_WIDTH)), int(c.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                  if c and dataset.mode == 'video' else None for c in vid_cap]  # read while the captures are open
+        ended = dataset.ended() if webcam else None
+        job = (path, img.shape[2:], im0s, pred, dataset.mode, descs, frames, videos, ended, (t1, t2, t3))
+        if opt.pipeline:
+            jobs.put(job)
+            if errors:
+                break
+        else:
+            process(*job)
+
+    if opt.pipeline:
+        jobs.put(None)
+        worker.join()
+        if errors:
+            raise errors[0]
+    vid_writers.release()
+    if webcam:
+        dataset.close()
+        for x in dataset.stats():
+            print(f"{x['source']}: {x['frames']} frames, {x['delivered']} processed, {x['skipped']} skipped, "
+                  f"{x['dropped']} dropped, {x['reconnects']} reconnects, lag {1E3 * x['lag']:.1f}ms "
+                  f"(max {1E3 * x['lag_max']:.1f}ms)")
 
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         #print(f"Results saved to {save_dir}{s}")
 
     print(f'Done. ({time.time() - t0:.3f}s)')
+    if Diagnostics.enabled:
+        print(f'Diagnostics: {Diagnostics.collect()}')
 
 
 if __name__ == '__main__':
@@ -201,6 +253,13 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='exp', help='save results to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+    parser.add_argument('--diagnostics', action='store_true', help='rate-limited debug output and run counters')
+    parser.add_argument('--batch-size', type=int, default=1, help='images (or videos side by side) per forward pass')
+    parser.add_argument('--pipeline', action='store_true', help='overlap decoding, inference and output in threads')
+    parser.add_argument('--workers', type=int, default=4, help='decoding threads of --pipeline')
+    parser.add_argument('--prefetch', type=int, default=8, help='frames queued between --pipeline stages')
+    parser.add_argument('--stream-stride', type=int, default=1, help='read every n-th frame of --source streams')
+    parser.add_argument('--stream-fifo', action='store_true', help='process buffered stream frames in order, not the latest')
     opt = parser.parse_args()
     print(opt)
     #check_requirements(exclude=('pycocotools', 'thop'))
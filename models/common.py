@@ -12,7 +12,7 @@ from torchvision.ops import DeformConv2d
 from PIL import Image
 from torch.cuda import amp
 
-from utils.datasets import letterbox
+from utils.datasets import letterbox_into, BatchBuffers
 from utils.general import non_max_suppression,non_max_suppression_MA, make_divisible, scale_coords, increment_path, xyxy2xywh
 from utils.plots import color_list, plot_one_box
 from utils.torch_utils import time_synchronized
@@ -871,6 +871,7 @@ class autoShape(nn.Module):
     def __init__(self, model):
         super(autoShape, self).__init__()
         self.model = model.eval()
+        self.buffers = BatchBuffers()  # letterboxed input batches, reused
 
     def autoshape(self):
         print('autoShape already enabled, skipping... ')  # model already converted to model.autoshape()
@@ -912,9 +913,9 @@ class autoShape(nn.Module):
             shape1.append([y * g for y in s])
             imgs[i] = im  # update
         shape1 = [make_divisible(x, int(self.stride.max())) for x in np.stack(shape1, 0).max(0)]  # inference shape
-        x = [letterbox(im, new_shape=shape1, auto=False)[0] for im in imgs]  # pad
-        x = np.stack(x, 0) if n > 1 else x[0][None]  # stack
-        x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
+        x = self.buffers.get((n, 3, *shape1), np.result_type(*imgs))  # BCHW batch
+        for im, out in zip(imgs, x):
+            letterbox_into(im, out, bgr=False)  # pad
         x = torch.from_numpy(x).to(p.device).type_as(p) / 255.  # uint8 to fp16/32
         t.append(time_synchronized())
 
@@ -9,7 +9,7 @@ import torch
 from models.common import *
 from models.experimental import *
 from utils.autoanchor import check_anchor_order
-from utils.general import make_divisible, check_file, set_logging
+from utils.general import make_divisible, check_file, set_logging, Diagnostics
 from utils.torch_utils import time_synchronized, fuse_conv_and_bn, model_info, scale_img, initialize_weights, \
     select_device, copy_attr
 from utils.loss import SigmoidBin
@@ -19,6 +19,8 @@ try:
 except ImportError:
     thop = None
 
+diag = Diagnostics(__name__)
+
 n_att=4
 
 class Detect(nn.Module):
@@ -140,7 +142,7 @@ class IDetect(nn.Module):
         return x if self.training else (torch.cat(z, 1), x)
     
     def fuseforward(self, x):
-        print("IDetect.fuseforward")
+        diag.count('IDetect.fuseforward')
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
@@ -180,7 +182,7 @@ class IDetect(nn.Module):
         return out
     
     def fuse(self):
-        print("IDetect.fuse")
+        diag.debug('IDetect.fuse')
         # fuse ImplicitA and Convolution
         for i in range(len(self.m)):
             c1,c2,_,_ = self.m[i].weight.shape
@@ -216,6 +218,7 @@ class IDetect_att2(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    lazy = False  # inference returns the raw conv outputs, gathered at surviving anchors by non_max_suppression_MA
 
     def __init__(self, n_classes=5, anchors=(), ch=()):  # detection layer
         super(IDetect_att2, self).__init__()
@@ -239,6 +242,8 @@ class IDetect_att2(nn.Module):
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
+            if self.lazy and not self.training:
+                continue
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
@@ -246,22 +251,26 @@ class IDetect_att2(nn.Module):
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
 
-                print("\ninference with sigmoid/softmax")
+                diag.debug('IDetect_att2 inference with sigmoid')
                 #y = x[i].softmax(-1)#
                 y = x[i].sigmoid()
                 #y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
                 #y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                 z.append(y.view(bs, -1, self.no))
 
+        if self.lazy and not self.training:
+            return x, x
         return x if self.training else (torch.cat(z, 1), x)
     
     def fuseforward(self, x):
-        print("IDetect_att2.fuseforward")
+        diag.count('IDetect_att2.fuseforward')
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
+            if self.lazy and not self.training:
+                continue
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
@@ -286,10 +295,12 @@ class IDetect_att2(nn.Module):
 
         if self.training:
             out = x
+        elif self.lazy:
+            out = (x, x)
         elif self.end2end:
             out = torch.cat(z, 1)
         elif self.include_nms:
-            print("Error,IDetect_att2.convert")
+            logger.warning('IDetect_att2.convert: attribute heads have no box and conf outputs to convert')
             z = self.convert(z)
             out = (z, )
         elif self.concat:
@@ -300,7 +311,7 @@ class IDetect_att2(nn.Module):
         return out
     
     def fuse(self):
-        print("IDetect_att2.fuse")
+        diag.debug('IDetect_att2.fuse')
         # fuse ImplicitA and Convolution
         for i in range(len(self.m)):
             c1,c2,_,_ = self.m[i].weight.shape
@@ -336,6 +347,7 @@ class IDetect_att3(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    lazy = False  # inference returns the raw conv outputs, gathered at surviving anchors by non_max_suppression_MA
 
     def __init__(self, n_classes=2, anchors=(), ch=()):  # detection layer
         super(IDetect_att3, self).__init__()
@@ -359,6 +371,8 @@ class IDetect_att3(nn.Module):
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
+            if self.lazy and not self.training:
+                continue
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
@@ -366,22 +380,26 @@ class IDetect_att3(nn.Module):
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
 
-                print("\ninference with sigmoid/softmax")
+                diag.debug('IDetect_att3 inference with sigmoid')
                 #y = x[i].softmax(-1)#
                 y = x[i].sigmoid()
                 #y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
                 #y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                 z.append(y.view(bs, -1, self.no))
 
+        if self.lazy and not self.training:
+            return x, x
         return x if self.training else (torch.cat(z, 1), x)
     
     def fuseforward(self, x):
-        print("IDetect_att3.fuseforward")
+        diag.count('IDetect_att3.fuseforward')
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
+            if self.lazy and not self.training:
+                continue
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
@@ -406,10 +424,12 @@ class IDetect_att3(nn.Module):
 
         if self.training:
             out = x
+        elif self.lazy:
+            out = (x, x)
         elif self.end2end:
             out = torch.cat(z, 1)
         elif self.include_nms:
-            print("Error,IDetect_att3.convert")
+            logger.warning('IDetect_att3.convert: attribute heads have no box and conf outputs to convert')
             z = self.convert(z)
             out = (z, )
         elif self.concat:
@@ -420,7 +440,7 @@ class IDetect_att3(nn.Module):
         return out
     
     def fuse(self):
-        print("IDetect_att3.fuse")
+        diag.debug('IDetect_att3.fuse')
         # fuse ImplicitA and Convolution
         for i in range(len(self.m)):
             c1,c2,_,_ = self.m[i].weight.shape
@@ -456,6 +476,7 @@ class IDetect_att4(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    lazy = False  # inference returns the raw conv outputs, gathered at surviving anchors by non_max_suppression_MA
 
     def __init__(self, n_classes=4, anchors=(), ch=()):  # detection layer
         super(IDetect_att4, self).__init__()
@@ -479,6 +500,8 @@ class IDetect_att4(nn.Module):
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
+            if self.lazy and not self.training:
+                continue
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
@@ -486,22 +509,26 @@ class IDetect_att4(nn.Module):
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
 
-                print("\ninference with sigmoid/softmax")
+                diag.debug('IDetect_att4 inference with sigmoid')
                 #y = x[i].softmax(-1)#
                 y = x[i].sigmoid()
                 #y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
                 #y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                 z.append(y.view(bs, -1, self.no))
 
+        if self.lazy and not self.training:
+            return x, x
         return x if self.training else (torch.cat(z, 1), x)
     
     def fuseforward(self, x):
-        print("IDetect_att4.fuseforward")
+        diag.count('IDetect_att4.fuseforward')
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
+            if self.lazy and not self.training:
+                continue
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
@@ -526,10 +553,12 @@ class IDetect_att4(nn.Module):
 
         if self.training:
             out = x
+        elif self.lazy:
+            out = (x, x)
         elif self.end2end:
             out = torch.cat(z, 1)
         elif self.include_nms:
-            print("Error,IDetect_att4.convert")
+            logger.warning('IDetect_att4.convert: attribute heads have no box and conf outputs to convert')
             z = self.convert(z)
             out = (z, )
         elif self.concat:
@@ -540,7 +569,7 @@ class IDetect_att4(nn.Module):
         return out
     
     def fuse(self):
-        print("IDetect_att4.fuse")
+        diag.debug('IDetect_att4.fuse')
         # fuse ImplicitA and Convolution
         for i in range(len(self.m)):
             c1,c2,_,_ = self.m[i].weight.shape
@@ -570,6 +599,85 @@ class IDetect_att4(nn.Module):
         box @= convert_matrix                          
         return (box, score)
 
+class IDetect_MA(nn.Module):
+    # Deploy-time fusion of the parallel multi-attribute heads (IDetect, IDetect_att2, ...) sharing the same inputs.
+    # Every head must already be fused (implicit layers folded, see IDetect.fuse), their 1x1 convs are concatenated
+    # into a single wide conv per scale, so each feature map is read once and split into per-head outputs afterwards.
+    stride = None  # strides computed during build
+    export = False  # onnx export
+    end2end = False
+    include_nms = False
+    concat = False
+    lazy = False  # attribute heads return the raw conv outputs, gathered at surviving anchors by non_max_suppression_MA
+
+    def __init__(self, heads):  # fused IDetect heads, box head first
+        super(IDetect_MA, self).__init__()
+        det = heads[0]
+        self.n_classes_lis = [h.n_classes for h in heads]  # number of classes per head
+        self.n_classes = det.n_classes
+        self.nos = [h.no for h in heads]  # number of outputs per anchor per head
+        self.no = det.no
+        self.nl = det.nl  # number of detection layers
+        self.na = det.na  # number of anchors
+        self.stride = det.stride
+        self.grid = [torch.zeros(1)] * self.nl  # init grid
+        self.register_buffer('anchors', det.anchors.clone())  # shape(nl,na,2)
+        self.register_buffer('anchor_grid', det.anchor_grid.clone())  # shape(nl,1,na,1,1,2)
+        self.m = nn.ModuleList()  # output conv
+        for i in range(self.nl):
+            convs = [h.m[i] for h in heads]
+            c = nn.Conv2d(convs[0].in_channels, sum(x.out_channels for x in convs), 1).to(convs[0].weight)
+            with torch.no_grad():
+                c.weight.copy_(torch.cat([x.weight for x in convs], 0))
+                c.bias.copy_(torch.cat([x.bias for x in convs], 0))
+            c.requires_grad_(convs[0].weight.requires_grad)
+            self.m.append(c)
+
+    def forward(self, x):
+        out = [[] for _ in self.nos]  # per head
+        z = [[] for _ in self.nos]  # per head inference output
+        self.training |= self.export
+        for i in range(self.nl):
+            bs, _, ny, nx = x[i].shape
+            for k, (xk, no) in enumerate(zip(self.m[i](x[i]).split([no * self.na for no in self.nos], 1), self.nos)):
+                if k and self.lazy and not self.training:
+                    out[k].append(xk)  # raw (bs,na*no,ny,nx) channel slice, no copy
+                    continue
+                xk = xk.view(bs, self.na, no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
+                out[k].append(xk)
+                if self.training:
+                    continue
+
+                y = xk.sigmoid()
+                if k == 0:  # box head
+                    if self.grid[i].shape[2:4] != xk.shape[2:4]:
+                        self.grid[i] = IDetect._make_grid(nx, ny).to(xk.device)
+                    if not torch.onnx.is_in_onnx_export():
+                        y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
+                        y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                    else:
+                        xy, wh, conf = y.split((2, 2, self.n_classes + 1), 4)
+                        xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
+                        wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
+                        y = torch.cat((xy, wh, conf), 4)
+                z[k].append(y.view(bs, -1, no))
+
+        if self.training:
+            return out
+        return [self.output(zk, xk, k == 0) for k, (zk, xk) in enumerate(zip(z, out))]
+
+    def output(self, z, x, box):
+        # Output of one head in the modes of IDetect.fuseforward, (x, x) for a lazy attribute head. With include_nms
+        # only the box head has boxes to convert, attribute heads give their scores
+        if not z:
+            return x, x
+        elif self.end2end or self.concat:
+            return torch.cat(z, 1)
+        elif self.include_nms:
+            return (IDetect.convert(self, z) if box else torch.cat(z, 1)),
+        return torch.cat(z, 1), x
+
+
 '''
 class IKeypoint(nn.Module):
     stride = None  # strides computed during build
@@ -983,7 +1091,8 @@ class Model(nn.Module):
     def forward_once(self, x, profile=False):
         #print("\nforward_once")
         out=[]
-        out_lis=len(self.model)-torch.tensor(list(range(1,n_att+1)))
+        fused_heads=isinstance(self.model[-1], IDetect_MA)
+        out_lis=len(self.model)-torch.tensor(list(range(1,(1 if fused_heads else n_att)+1)))
         #print(out_lis)
         #print(self.save)
         y, dt = [], []  # outputs
@@ -996,11 +1105,11 @@ class Model(nn.Module):
 
             if self.traced:
                 #print("\ntraced")
-                if isinstance(m, Detect) or isinstance(m, IDetect) or isinstance(m, IDetect_color) or isinstance(m, IAuxDetect) or isinstance(m, IKeypoint):
+                if isinstance(m, Detect) or isinstance(m, IDetect) or isinstance(m, IDetect_MA) or isinstance(m, IDetect_color) or isinstance(m, IAuxDetect) or isinstance(m, IKeypoint):
                     break
 
             if profile:
-                c = isinstance(m, (Detect, IDetect,IDetect_color,IAuxDetect, IBin))
+                c = isinstance(m, (Detect, IDetect,IDetect_MA,IDetect_color,IAuxDetect, IBin))
                 o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPS
                 for _ in range(10):
                     m(x.copy() if c else x)
@@ -1016,7 +1125,9 @@ class Model(nn.Module):
             #debug before detect-head
             #if m.i==104:
                 #print(m.i,x.size())
-            if m.i in out_lis:
+            if fused_heads and m is self.model[-1]:
+                out.extend(x)  # one output per fused head
+            elif m.i in out_lis:
                 out.append(x)
                 #print(m.i,x[0].size(),len(x))
 
@@ -1107,12 +1218,25 @@ class Model(nn.Module):
                 m.conv = fuse_conv_and_bn(m.conv, m.bn)  # update conv
                 delattr(m, 'bn')  # remove batchnorm
                 m.forward = m.fuseforward  # update forward
-            elif isinstance(m, (IDetect,IDetect_color, IAuxDetect)):
+            elif isinstance(m, (IDetect, IDetect_att2, IDetect_att3, IDetect_att4)):
                 m.fuse()
                 m.forward = m.fuseforward
+        self.fuse_heads()
         self.info()
         return self
 
+    def fuse_heads(self):  # concatenate the parallel multi-attribute heads into one IDetect_MA
+        heads = list(self.model[-n_att:])
+        if not all(isinstance(m, (IDetect, IDetect_att2, IDetect_att3, IDetect_att4)) for m in heads) or \
+                not isinstance(heads[0], IDetect) or any(m.f != heads[0].f for m in heads):
+            return self
+        print('Fusing heads... ')
+        m = IDetect_MA(heads).train(heads[0].training)
+        m.i, m.f, m.type = heads[0].i, heads[0].f, 'models.yolo.IDetect_MA'  # attach index, 'from' index, type
+        m.np = sum(x.numel() for x in m.parameters())  # number params
+        self.model = nn.Sequential(*list(self.model)[:-n_att], m)
+        return self
+
     def nms(self, mode=True):  # add or remove NMS module
         present = type(self.model[-1]) is NMS  # last layer is NMS
         if mode and not present:
@@ -2,7 +2,6 @@ import argparse
 import json
 import os
 from pathlib import Path
-from threading import Thread
 
 import numpy as np
 import torch
@@ -12,10 +11,10 @@ from tqdm import tqdm
 from models.experimental import attempt_load
 from utils.datasets import create_dataloader
 from utils.general import coco80_to_coco91_class, check_dataset, check_file, check_img_size, check_requirements, \
-    box_iou, non_max_suppression,non_max_suppression_MA, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
-from utils.metrics import ap_per_class, ConfusionMatrix
-from utils.plots import plot_images, output_to_target, plot_study_txt
-from utils.torch_utils import select_device, time_synchronized, TracedModel,is_parallel
+    non_max_suppression,non_max_suppression_MA, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
+from utils.metrics import APStats, ConfusionMatrix, match_predictions
+from utils.plots import ImagePlotter, output_to_target, plot_study_txt
+from utils.torch_utils import select_device, time_synchronized, TracedModel, InputStager, is_parallel
 
 n_att=4
 
@@ -41,7 +40,8 @@ def test(data,
          half_precision=True,
          trace=False,
          is_coco=False,
-         v5_metric=False):
+         v5_metric=False,
+         ap_bins=0):
     # Initialize/load model and set device
     training = model is not None
     if training:  # called by train.py
@@ -97,6 +97,7 @@ def test(data,
     
     seen = 0
     confusion_matrix = [ConfusionMatrix(nc=model.n_classes_lis[k]) for k in range(n_att)]
+    plotter = ImagePlotter()  # renders test_batch*.jpg in the background
     names_classes_lis=[]
     for kk in range(n_att):
         names_classes_lis.append({k: v for k, v in enumerate(model.module.names_classes_lis[kk] if is_parallel(model) else model.names_classes_lis[kk])})
@@ -105,11 +106,11 @@ def test(data,
     p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., [0. for i in range(n_att)], [0. for i in range(n_att)], [0. for i in range(n_att)], [0. for i in range(n_att)], 0., 0.
     loss = torch.zeros(2+n_att, device=device)
     loss_att=torch.zeros((n_att,3),device=device)
-    jdict, stats, ap, ap_class, wandb_images = [], [[] for i in range(n_att)], [[] for i in range(n_att)], [[] for i in range(n_att)], []
+    stats = [APStats(model.n_classes_lis[k], niou, ap_bins, device) for k in range(n_att)]
+    stager = InputStager(device, half)  # uint8 batches to normalized device inputs
+    jdict, ap, ap_class, wandb_images = [], [[] for i in range(n_att)], [[] for i in range(n_att)], []
     for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
-        img = img.to(device, non_blocking=True)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        img = stager(img)  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
         targets = targets.to(device)
         nb, _, height, width = img.shape  # batch size, channels, height, width
 
@@ -170,7 +171,7 @@ def test(data,
             if len(pred) == 0:
                 if nl:
                     for k in range(n_att):
-                        stats[k].append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), [x[k] for x in tcls]))
+                        stats[k].update(torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), [x[k] for x in tcls])
                 continue
             
             #print("\npred",len(pred),pred[0])
@@ -217,7 +218,6 @@ def test(data,
             # Assign all predictions as incorrect
             correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
             if nl:
-                detected = []  # target indices
                 tcls_tensor = labels[:, 0]
 
                 # target boxes
@@ -229,49 +229,31 @@ def test(data,
                         confusion_label=torch.cat((labels[:,k:k+1],tbox),-1)
                         confusion_matrix[k].process_batch(confusion_pred, confusion_label)
 
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero(as_tuple=False).contiguous().view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero(as_tuple=False).contiguous().view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(predn[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        detected_set = set()
-                        for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                            d = ti[i[j]]  # detected target
-                            if d.item() not in detected_set:
-                                detected_set.add(d.item())
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
+                # Match detections to targets, all classes at once
+                correct = match_predictions(predn[:, :4], pred[:, 5], tbox, tcls_tensor, iouv)
 
             # Append statistics (correct, conf, pcls, tcls)
             for k in range(n_att):
-                stats[k].append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5+k].cpu(), [x[k] for x in tcls]))
+                stats[k].update(correct, pred[:, 4], pred[:, 5+k], [x[k] for x in tcls])
 
         # Plot images
         if plots and batch_i < 3:
             f = save_dir / f'test_batch{batch_i}_labels.jpg'  # 
-            Thread(target=plot_images, args=(img, targets, paths, f, names_classes_lis), daemon=True).start()
+            plotter(img, targets, paths, f, names_classes_lis, normalized=True)
             f = save_dir / f'test_batch{batch_i}_pred.jpg'  # predictions
-            Thread(target=plot_images, args=(img, output_to_target(out), paths, f, names_classes_lis), daemon=True).start()
+            plotter(img, output_to_target(out[:plotter.max_subplots]), paths, f, names_classes_lis, normalized=True)
 
     # Compute statistics
     #print("\nstats",len(stats),len(stats[0]),(batch_i+1)*(si+1),stats[0][0])
     for k in range(n_att):
         #print("\nstats",len(stats),len(stats[0]),stats[0])
-        each_stats = [np.concatenate(x, 0) for x in zip(*(stats[k]))]  # to numpy
-        if len(each_stats) and each_stats[0].any():
+        each_ap = stats[k].ap_per_class(plot=plots, v5_metric=v5_metric, save_dir=save_dir, names=names_classes_lis[k])
+        if each_ap is not None:
             #print("\neach_status true")
-            p, r, ap[k], f1, ap_class[k] = ap_per_class(*each_stats, plot=plots, v5_metric=v5_metric, save_dir=save_dir, names=names_classes_lis[k])
+            p, r, ap[k], f1, ap_class[k] = each_ap
             ap50, ap[k] = ap[k][:, 0], ap[k].mean(1)  # AP@0.5, AP@0.5:0.95
             mp[k], mr[k], map50[k], map[k] = p.mean(), r.mean(), ap50.mean(), ap[k].mean()
-            nt = np.bincount(each_stats[3].astype(np.int64), minlength=model.n_classes_lis[k])  # number of targets per class
+            nt = stats[k].labels  # number of targets per class
         else:
             #print("\neach_status false")
             nt = torch.zeros(1)
@@ -281,7 +263,7 @@ def test(data,
         print(pf % ('all', seen, nt.sum(), mp[k], mr[k], map50[k], map[k]))
 
         # Print results per class
-        if (verbose or (model.n_classes_lis[k] < 50 and not training)) and model.n_classes_lis[k] > 1 and len(each_stats):
+        if (verbose or (model.n_classes_lis[k] < 50 and not training)) and model.n_classes_lis[k] > 1 and each_ap is not None:
             for i, c in enumerate(ap_class[k]):
                 print(pf % (names_classes_lis[k][c], seen, nt[c], p[i], r[i], ap50[i], ap[k][i]))
 
@@ -291,6 +273,7 @@ def test(data,
         print('Speed: %.1f/%.1f/%.1f ms inference/NMS/total per %gx%g image at batch-size %g' % t)
 
     # Plots
+    plotter.close()
     if plots:
         for k in range(n_att):
             confusion_matrix[k].plot(save_dir=save_dir, names=list(names_classes_lis[k].values()))
@@ -365,6 +348,7 @@ if __name__ == '__main__':
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
     parser.add_argument('--v5-metric', action='store_true', help='assume maximum recall as 1.0 in AP calculation')
+    parser.add_argument('--ap-bins', type=int, default=0, help='confidence bins of the bounded-memory mAP stats, 0 for exact')
     opt = parser.parse_args()
     opt.save_json |= opt.data.endswith('coco.yaml')
     opt.data = check_file(opt.data)  # check file
@@ -386,7 +370,8 @@ if __name__ == '__main__':
              save_hybrid=opt.save_hybrid,
              save_conf=opt.save_conf,
              trace=not opt.no_trace,
-             v5_metric=opt.v5_metric
+             v5_metric=opt.v5_metric,
+             ap_bins=opt.ap_bins
              )
 
     elif opt.task == 'speed':  # speed benchmarks
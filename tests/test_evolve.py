@@ -0,0 +1,124 @@
+# evolve_hyps() scheduling --evolve candidates in spawned CPU workers, sharing a locked evolve.txt (EvolveStore) and
+# stopping candidates below the median early fitness (EvolveStopper)
+
+import argparse
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from utils.general import EvolveStore, EvolveStopper, evolve_hyps
+from utils.plots import plot_evolution
+
+HYP = {'lr0': 0.01, 'momentum': 0.937, 'weight_decay': 0.0005}
+META = {'lr0': (1, 1e-5, 1e-1), 'momentum': (0.3, 0.6, 0.98), 'weight_decay': (1, 0.0, 0.001)}
+
+
+def tiny_candidate(i, hyp, opt, device, threads, stopper, results_queue):
+    # Stands in for train.evolve_candidate: odd candidates train to fitness 0.1, even ones to 0.9, checking the stopper
+    # after stopper.epoch epochs like train() does. Candidates in opt.fail raise, candidates in opt.crash are killed
+    Path(opt.save_dir).mkdir(parents=True, exist_ok=True)
+    (Path(opt.save_dir) / f'{i}.pid').write_text(f'{os.getpid()} {device} {threads}')
+    if i in opt.crash:
+        os._exit(1)
+    try:
+        if i in opt.fail:
+            raise RuntimeError(f'candidate {i} diverged')
+        fi, epochs = (0.1 if i % 2 else 0.9), opt.epochs
+        for epoch in range(opt.epochs):
+            if stopper is not None and epoch + 1 == stopper.epoch and epoch + 1 < opt.epochs and stopper(fi):
+                epochs = epoch + 1
+                break
+        results_queue.put((i, hyp, (fi, fi, fi, fi, 0.05, 0.02, 0.01), epochs,
+                           stopper.fitness if stopper else float('nan'), None))
+    except Exception as e:
+        results_queue.put((i, hyp, None, 0, 0, repr(e)))
+
+
+def append_rows(path, worker, n):
+    store = EvolveStore(path)
+    for k in range(n):
+        store.append((worker, k, 0.5, 0.5, 0, 0, 0), {f'h{j}': worker + j / 100 for j in range(40)}, 3)
+
+
+def test_evolve_store_concurrent_appends(tmp_path):
+    path, nw, n = tmp_path / 'evolve.txt', 4, 50
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=append_rows, args=(path, w, n)) for w in range(nw)]
+    for p in procs:
+        p.start()
+    store = EvolveStore(path)
+    while any(p.is_alive() for p in procs):
+        store.read()  # incremental reads while other processes append
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+    x = store.read()
+    assert x.shape == (nw * n, 7 + 40 + 2)
+    assert not np.isnan(x[:, :-1]).any()  # no torn or interleaved rows
+    for w in range(nw):
+        assert sorted(x[x[:, 0] == w, 1]) == list(range(n))
+    np.testing.assert_array_equal(EvolveStore(path).read(), x)  # incremental reads == one full read
+
+
+def test_evolve_stopper_median(tmp_path):
+    store = EvolveStore(tmp_path / 'evolve.txt')
+    stopper = EvolveStopper(store, epoch=1)
+    for fi in 0.2, 0.4:
+        store.append((fi,) * 4 + (0, 0, 0), HYP, 3, fi)
+        assert not stopper(0.0)  # fewer than n=3 early fitness values recorded
+    store.append((0.6,) * 4 + (0, 0, 0), HYP, 3, 0.6)
+    store.append((0.8,) * 4 + (0, 0, 0), HYP, 3)  # no early fitness (--evolve-stop off), ignored
+    assert stopper(0.3) and stopper.stopped and stopper.fitness == 0.3
+    assert not stopper(0.4) and not stopper(0.5)
+
+
+def test_evolve_hyps(tmp_path, caplog):
+    # A tiny 6 candidate, 3 epoch run on 2 CPU workers, stopping after 1 epoch below the median
+    store = EvolveStore(tmp_path / 'evolve.txt')
+    for _ in range(3):  # earlier candidates, early fitness 0.5
+        store.append((0.5,) * 4 + (0, 0, 0), HYP, 3, 0.5)
+    opt = argparse.Namespace(evolve=6, evolve_workers=2, evolve_stop=1, epochs=3, device='cpu',
+                             save_dir=str(tmp_path / 'evolve'), fail=(3,), crash=(5,))
+    yaml_file = tmp_path / 'hyp_evolved.yaml'
+    with caplog.at_level(logging.WARNING):
+        evolve_hyps(HYP, META, opt, store, tiny_candidate, yaml_file, timeout=1)
+
+    # Spawned workers, one run directory each
+    pids = {}
+    for w in range(2):
+        for f in (tmp_path / 'evolve' / f'worker{w}').glob('*.pid'):
+            pid, device, threads = f.read_text().split()
+            pids[int(f.stem)] = int(pid)
+            assert device == 'cpu' and int(threads) >= 1
+    assert sorted(pids) == list(range(6))
+    assert len(set(pids.values())) == 6 and os.getpid() not in pids.values()
+
+    # Failed and killed candidates are logged and not recorded
+    assert 'candidate 3 failed' in caplog.text and 'candidate 5 exited with code 1' in caplog.text
+    x = EvolveStore(tmp_path / 'evolve.txt').read()
+    assert len(x) == 3 + 4
+    fi, epochs, early_fitness = x[3:, 3], x[3:, 7 + len(HYP)], x[3:, -1]
+    np.testing.assert_allclose(np.sort(fi), [0.1, 0.9, 0.9, 0.9])
+    assert (epochs[fi < 0.5] == 1).all() and (epochs[fi > 0.5] == 3).all()  # stopped below the median only
+    np.testing.assert_allclose(early_fitness, fi)
+    for k, (gain, lower, upper) in META.items():  # mutations within limits
+        assert ((x[:, 7 + list(HYP).index(k)] >= lower) & (x[:, 7 + list(HYP).index(k)] <= upper)).all()
+    assert yaml_file.exists()
+
+
+def test_plot_evolution_mixed_rows(tmp_path, monkeypatch):
+    # evolve.txt resumed from older runs: rows without the epochs and early fitness columns, one without the last hyp
+    monkeypatch.chdir(tmp_path)
+    with open('evolve.txt', 'w') as f:
+        f.write('%10.4g' * (7 + 3) % (0.5, 0.5, 0.4, 0.3, 0, 0, 0, 0.01, 0.9, 0.0005) + '\n')
+        f.write('%10.4g' * (7 + 2) % (0.5, 0.5, 0.6, 0.5, 0, 0, 0, 0.02, 0.8) + '\n')
+    EvolveStore('evolve.txt').append((0.5, 0.5, 0.5, 0.4, 0, 0, 0), HYP, 3, 0.4)
+    with open('hyp_evolved.yaml', 'w') as f:
+        yaml.dump(HYP, f, sort_keys=False)
+    plot_evolution('hyp_evolved.yaml')
+    assert (tmp_path / 'evolve.png').exists()
@@ -0,0 +1,175 @@
+# IDetect_MA against the separately fused heads it concatenates, in every inference and export output mode, and
+# Model.fuse() swapping it in for the heads of a tiny hand-built Model
+
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from models.common import Conv
+from models.yolo import IDetect, IDetect_att2, IDetect_att3, IDetect_att4, IDetect_MA, Model
+
+ANCHORS = ([12, 16, 19, 36, 40, 28], [36, 75, 76, 55, 72, 146], [142, 110, 192, 243, 459, 401])
+CH = (32, 64, 128)
+
+
+def fused_heads(seed=0):
+    torch.manual_seed(seed)
+    heads = [IDetect(3, ANCHORS, CH), IDetect_att2(5, ANCHORS, CH), IDetect_att3(2, ANCHORS, CH),
+             IDetect_att4(4, ANCHORS, CH)]
+    with torch.no_grad():
+        for h in heads:
+            h.stride = torch.tensor([8., 16., 32.])
+            h.anchor_grid *= 1.0
+            for p in h.parameters():
+                p.normal_(0, 0.1)
+            h.fuse()
+            h.forward = h.fuseforward
+            h.eval()
+    return heads
+
+
+def inputs(bs=2):
+    return [torch.randn(bs, c, 64 // s, 64 // s) for c, s in zip(CH, (8, 16, 32))]
+
+
+def assert_close(a, b):
+    if isinstance(a, torch.Tensor):
+        assert torch.allclose(a, b, atol=1e-5), (a - b).abs().max()
+    else:
+        assert type(a) is type(b) and len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_close(x, y)
+
+
+@pytest.mark.parametrize('mode', [None, 'end2end', 'include_nms', 'concat', 'lazy'])
+def test_fused_heads_outputs(mode):
+    heads = fused_heads()
+    m = IDetect_MA(heads).eval()
+    x = inputs()
+    for h in [m] + heads[1:]:
+        if mode == 'lazy':
+            h.lazy = True
+        elif mode:
+            setattr(h, mode, True)
+    if mode:
+        setattr(heads[0], mode, mode != 'lazy')  # the box head is never lazy
+    if mode == 'include_nms':  # attribute heads have no boxes to convert, they give their scores
+        for h in heads[1:]:
+            h.include_nms, h.concat = False, True
+    with torch.no_grad():
+        expected = [h(copy.copy(x)) for h in heads]
+        out = m(copy.copy(x))
+    if mode == 'include_nms':
+        expected = expected[:1] + [(e, ) for e in expected[1:]]
+    assert len(out) == len(heads)
+    for o, e in zip(out, expected):
+        assert_close(o, e)
+
+
+def test_fused_heads_export_grid():
+    # export without --grid returns the raw per-head outputs
+    heads = fused_heads(1)
+    m = IDetect_MA(heads).eval()
+    x = inputs()
+    m.export = True
+    for h in heads:
+        h.export = True
+    with torch.no_grad():
+        expected = [h(copy.copy(x)) for h in heads]
+        out = m(copy.copy(x))
+    for o, e in zip(out, expected):
+        assert_close(o, e)
+
+
+def tiny_model(seed=0, shared=True):
+    # Conv backbone with P3-P5 outputs (layers 2-4) and the 4 attribute heads on them, the last one on layer 5 instead
+    # of 4 unless shared. Model.__init__ needs a yaml, the layers are attached like parse_model() does
+    torch.manual_seed(seed)
+    layers = [Conv(3, 8, 3, 2), Conv(8, 16, 3, 2), Conv(16, CH[0], 3, 2), Conv(CH[0], CH[1], 3, 2),
+              Conv(CH[1], CH[2], 3, 2), Conv(CH[2], CH[2], 1, 1)]
+    froms = [-1] * 5 + [4] + [[2, 3, 4]] * 3 + [[2, 3, 4] if shared else [2, 3, 5]]
+    layers += [IDetect(3, ANCHORS, CH), IDetect_att2(5, ANCHORS, CH), IDetect_att3(2, ANCHORS, CH),
+               IDetect_att4(4, ANCHORS, CH)]
+    for i, (m, f) in enumerate(zip(layers, froms)):
+        m.i, m.f, m.type, m.np = i, f, type(m).__name__, sum(x.numel() for x in m.parameters())
+    model = Model.__new__(Model)
+    nn.Module.__init__(model)
+    model.model, model.save, model.yaml, model.traced = nn.Sequential(*layers), [2, 3, 4, 5], {'ch': 3}, False
+    model.stride = torch.tensor([8., 16., 32.])
+    with torch.no_grad():
+        for m in layers[6:]:
+            m.stride = model.stride
+            m.anchors /= m.stride.view(-1, 1, 1)
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.running_mean.normal_(0, 0.1)
+                m.running_var.uniform_(0.5, 1.5)
+    return model.requires_grad_(False).eval()  # like the EMA models in checkpoints
+
+
+def image(bs=2):
+    return torch.randn(bs, 3, 64, 64)
+
+
+def set_mode(model, mode):
+    # Set an output mode on every head, as detect.py (lazy) and export.py (on model.model[-1]) do for fused heads
+    for m in model.model:
+        if mode == 'lazy':
+            if hasattr(m, 'lazy'):
+                m.lazy = True
+        elif mode == 'include_nms' and isinstance(m, (IDetect_att2, IDetect_att3, IDetect_att4)):
+            m.concat = True  # attribute heads have no boxes to convert, they give their scores
+        elif mode and hasattr(m, mode):
+            setattr(m, mode, True)
+
+
+@pytest.mark.parametrize('mode', [None, 'lazy', 'export'])
+def test_model_fuse(mode):
+    # Model.fuse() folds BN and the implicit layers and swaps in IDetect_MA, forward_once() gives per-head outputs
+    model = tiny_model()
+    fused = copy.deepcopy(model).fuse()
+    assert isinstance(fused.model[-1], IDetect_MA) and len(fused.model) == 7
+    set_mode(model, mode)
+    set_mode(fused, mode)
+    x = image()
+    with torch.no_grad():
+        expected, out = model(x), fused(x)
+    assert len(out) == 4
+    for o, e in zip(out, expected):
+        assert_close(o, e)
+
+
+@pytest.mark.parametrize('mode', ['end2end', 'include_nms', 'concat'])
+def test_model_fuse_export_modes(mode, monkeypatch):
+    # The export modes exist in the fused forwards only: IDetect_MA against the heads fused one by one
+    model = tiny_model(1)
+    fused = copy.deepcopy(model).fuse()
+    with monkeypatch.context() as m:
+        m.setattr(Model, 'fuse_heads', lambda self: self)
+        heads = copy.deepcopy(model).fuse()
+    assert isinstance(heads.model[-1], IDetect_att4)
+    set_mode(heads, mode)
+    setattr(fused.model[-1], mode, True)  # export.py
+    x = image()
+    with torch.no_grad():
+        expected, out = heads(x), fused(x)
+    if mode == 'include_nms':
+        expected = expected[:1] + [(e, ) for e in expected[1:]]
+    for o, e in zip(out, expected):
+        assert_close(o, e)
+
+
+def test_model_fuse_unshared_heads():
+    # Heads reading different layers are fused one by one, not concatenated
+    model = tiny_model(2, shared=False)
+    fused = copy.deepcopy(model).fuse()
+    assert not any(isinstance(m, IDetect_MA) for m in fused.modules()) and len(fused.model) == 10
+    x = image()
+    with torch.no_grad():
+        expected, out = model(x), fused(x)
+    for o, e in zip(out, expected):
+        assert_close(o, e)
@@ -0,0 +1,57 @@
+# APStats: binned stats against the exact ones (bins=0) within the documented tolerance, merging shards by addition
+
+import numpy as np
+import pytest
+import torch
+
+import utils.general  # noqa: F401, before utils.metrics, the two import each other
+from utils.metrics import APStats
+
+NC, NIOU = 9, 10
+
+
+def images(seed, n=500, skew=4.0):
+    # Per image (correct, conf, pred_cls, target_cls), confidences skewed toward conf_thres=0.001, TPs likelier at high
+    # confidence
+    rng = np.random.RandomState(seed)
+    out = []
+    for _ in range(n):
+        tcls = rng.randint(0, NC, rng.randint(0, 20))
+        m = rng.randint(50, 300)
+        conf = np.sort(0.001 + 0.999 * rng.random_sample(m) ** skew)[::-1].copy()
+        tp = rng.random_sample(m) < conf ** 0.7 * 0.6 * (len(tcls) > 0)
+        iou = 0.5 + 0.5 * rng.random_sample(m) ** 0.5
+        correct = tp[:, None] & (iou[:, None] > np.linspace(0.5, 0.95, NIOU))
+        out.append((torch.from_numpy(correct), torch.from_numpy(conf).float(), torch.from_numpy(rng.randint(0, NC, m)),
+                    tcls.tolist()))
+    return out
+
+
+def accumulate(stats, data):
+    for x in data:
+        stats.update(*x)
+    return stats
+
+
+@pytest.mark.parametrize('seed, skew', [(0, 1.0), (1, 4.0), (2, 8.0)])
+def test_binned_tolerance(seed, skew):
+    data = images(seed, skew=skew)
+    p, r, ap, f1, _ = accumulate(APStats(NC, NIOU), data).ap_per_class()
+    pb, rb, apb, f1b, _ = accumulate(APStats(NC, NIOU, bins=1000), data).ap_per_class()
+    assert abs(apb[:, 0].mean() - ap[:, 0].mean()) < 2e-3 and abs(apb.mean() - ap.mean()) < 2e-3
+    assert abs(f1b.mean() - f1.mean()) < 1e-3
+    assert abs(pb.mean() - p.mean()) < 1e-1 and abs(rb.mean() - r.mean()) < 1e-1
+
+
+@pytest.mark.parametrize('bins', [0, 1000])
+def test_merge(bins):
+    # Stats of 3 shards merged == stats of all images, bit for bit
+    data = images(3, n=150)
+    full = accumulate(APStats(NC, NIOU, bins), data)
+    merged = accumulate(APStats(NC, NIOU, bins), data[:40])
+    for shard in data[40:100], data[100:]:
+        merged.merge(accumulate(APStats(NC, NIOU, bins), shard))
+    for x, y in zip(full.compute(), merged.compute()):
+        np.testing.assert_array_equal(x, y)
+    for x, y in zip(full.ap_per_class(), merged.ap_per_class()):
+        np.testing.assert_array_equal(x, y)
@@ -0,0 +1,70 @@
+# mosaic_perspective(): the fused tile warp is opt-in and only replaces the 114-filled canvas warp for affine mosaics
+
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import utils.datasets as datasets
+from utils.datasets import mosaic_perspective, n_att
+
+HYP = {'degrees': 10.0, 'translate': 0.2, 'scale': 0.9, 'shear': 2.0, 'perspective': 0.0, 'copy_paste': 0.0}
+
+
+def mosaic(seed, s=160):
+    # 4 random tiles around a random center of a 2s x 2s mosaic, like load_mosaic, and 3 boxes per tile
+    rng = np.random.RandomState(seed)
+    xc, yc = rng.randint(s // 2, 3 * s // 2, 2)
+    tiles, labels = [], []
+    for i in range(4):
+        h, w = rng.randint(s // 2, s + 1, 2)
+        x, y = xc - w * (i % 2 == 0), yc - h * (i < 2)
+        tiles.append((rng.randint(0, 256, (h, w, 3), dtype=np.uint8), x, y))
+        xy = np.sort(rng.uniform(0, 1, (3, 2, 2)), 1) * (w, h) + (x, y)  # (box, x1y1/x2y2, xy)
+        labels.append(np.concatenate((rng.randint(0, 2, (3, n_att)), xy.reshape(3, 4)), 1))
+    labels = np.clip(np.concatenate(labels, 0), 0, 2 * s)
+    return tiles, labels
+
+
+def sample(seed, fused, **hyp):
+    s = 160
+    tiles, labels = mosaic(seed, s)
+    dataset = SimpleNamespace(hyp={**HYP, **hyp}, img_size=s, mosaic_border=[-s // 2, -s // 2], fused_mosaic=fused)
+    random.seed(seed)
+    return mosaic_perspective(dataset, tiles, labels, [])
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_canvas_default(seed):
+    # Without fused_mosaic the canvas is built and warped by random_perspective() as before
+    tiles, labels = mosaic(seed)
+    random.seed(seed)
+    img, out = datasets.random_perspective(datasets.render_mosaic(tiles, (320, 320)), labels, [],
+                                           degrees=HYP['degrees'], translate=HYP['translate'], scale=HYP['scale'],
+                                           shear=HYP['shear'], border=[-80, -80])
+    img2, out2 = sample(seed, False)
+    np.testing.assert_array_equal(img, img2)
+    np.testing.assert_array_equal(out, out2)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_fused_affine_only(seed, monkeypatch):
+    calls = []
+    warp = datasets.warp_mosaic
+    monkeypatch.setattr(datasets, 'warp_mosaic', lambda *args, **kwargs: calls.append(1) or warp(*args, **kwargs))
+
+    # Perspective and copy-paste mosaics are warped from the canvas even with fused_mosaic
+    for hyp in {'perspective': 0.0005}, {'copy_paste': 0.5}:
+        img, labels = sample(seed, True, **hyp)
+        img2, labels2 = sample(seed, False, **hyp)
+        np.testing.assert_array_equal(img, img2)
+        np.testing.assert_array_equal(labels, labels2)
+    assert not calls
+
+    # Affine mosaics are rendered from the tiles, same labels, images differ along the tile seams only
+    img, labels = sample(seed, True)
+    img2, labels2 = sample(seed, False)
+    assert calls
+    np.testing.assert_array_equal(labels, labels2)
+    assert (img != img2).any(2).mean() < 0.08  # seams of 160 pixel tiles
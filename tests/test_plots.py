@@ -0,0 +1,23 @@
+# ImagePlotter: mosaics rendered in the background thread from the normalization state given by the caller
+
+import cv2
+import numpy as np
+import torch
+
+from utils.datasets import n_att
+from utils.plots import ImagePlotter, output_to_target
+
+
+def test_image_plotter_normalized(tmp_path):
+    # 0 - 255 and 0.0 - 1.0 batches give the same mosaic, dark images included, boxes scaled to the thumbnails
+    imgs = torch.randint(0, 2, (4, 3, 1280, 960)).float()  # 0 - 255 but max <= 1
+    out = [torch.tensor([[100., 100., 600., 800., 0.9] + [1.] * n_att])] * 2
+    targets = output_to_target(out)
+    plotter = ImagePlotter()
+    assert plotter(imgs, targets, fname=tmp_path / 'a.jpg', normalized=False)
+    assert plotter(imgs / 255, targets, fname=tmp_path / 'b.jpg', normalized=True)
+    plotter.close()
+    a, b = cv2.imread(str(tmp_path / 'a.jpg')), cv2.imread(str(tmp_path / 'b.jpg'))
+    assert a.shape == b.shape and np.abs(a.astype(int) - b).max() <= 2
+    assert np.median(a) <= 2  # dark images stay dark
+    assert targets[:, 1 + n_att:5 + n_att].max() > 600  # caller's targets not rescaled in place
@@ -0,0 +1,89 @@
+# simota_assign() against the per-image, per-target SimOTA loop it replaced in ComputeLossOTA.build_targets_BCE
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.general import box_iou, xywh2xyxy
+from utils.loss import simota_assign
+
+
+def simota_reference(cand_b, pxyxys, p_obj, p_cls, t_b, txyxy, t_cls, bs):
+    # The previous build_targets_BCE matching, one image and one target at a time
+    cand_out, t_out = [], []
+    for batch_idx in range(bs):
+        this_tinds = (t_b == batch_idx).nonzero(as_tuple=False).view(-1)
+        this_cinds = (cand_b == batch_idx).nonzero(as_tuple=False).view(-1)
+        if this_tinds.shape[0] == 0 or this_cinds.shape[0] == 0:
+            continue
+        pxy = pxyxys[this_cinds]
+        pair_wise_iou = box_iou(txyxy[this_tinds], pxy)
+        pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+        top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
+        dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
+
+        num_gt = this_tinds.shape[0]
+        gt_cls_per_image = F.one_hot(t_cls[this_tinds], p_cls.shape[1]).float().unsqueeze(1).repeat(1, len(pxy), 1)
+        cls_preds_ = (p_cls[this_cinds].float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
+                      * p_obj[this_cinds].unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_())
+        y = cls_preds_.sqrt_()
+        pair_wise_cls_loss = F.binary_cross_entropy_with_logits(torch.log(y / (1 - y)), gt_cls_per_image,
+                                                                reduction="none").sum(-1)
+        cost = pair_wise_cls_loss + 3.0 * pair_wise_iou_loss
+
+        matching_matrix = torch.zeros_like(cost)
+        for gt_idx in range(num_gt):
+            _, pos_idx = torch.topk(cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False)
+            matching_matrix[gt_idx][pos_idx] = 1.0
+        anchor_matching_gt = matching_matrix.sum(0)
+        if (anchor_matching_gt > 1).sum() > 0:
+            _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
+            matching_matrix[:, anchor_matching_gt > 1] *= 0.0
+            matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
+        fg_mask_inboxes = matching_matrix.sum(0) > 0.0
+        matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
+        cand_out.append(this_cinds[fg_mask_inboxes])
+        t_out.append(this_tinds[matched_gt_inds])
+    if not cand_out:
+        return torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=torch.long)
+    return torch.cat(cand_out), torch.cat(t_out)
+
+
+def random_batch(seed, bs=6, nc=5, img_size=320):
+    # Targets and candidate boxes around them, images 0 and bs - 1 have no targets, image 1 has no candidates
+    g = torch.Generator().manual_seed(seed)
+    nt = torch.randint(0, 8, (bs,), generator=g)
+    nt[0] = nt[-1] = 0
+    t_b = torch.arange(bs).repeat_interleave(nt)
+    t_b = t_b[torch.randperm(len(t_b), generator=g)]  # targets of an image need not be contiguous
+    txywh = torch.cat((torch.rand(len(t_b), 2, generator=g) * 0.8 + 0.1,
+                       torch.rand(len(t_b), 2, generator=g) * 0.3 + 0.02), 1)
+    t_cls = torch.randint(0, nc, (len(t_b),), generator=g)
+
+    owner = torch.randint(0, len(t_b), (len(t_b) * 30,), generator=g)  # 30 candidates per target on average
+    cand_b = t_b[owner]
+    keep = cand_b != 1
+    owner, cand_b = owner[keep], cand_b[keep]
+    cxywh = txywh[owner] * img_size + torch.randn(len(owner), 4, generator=g) * 8
+    cxywh[:, 2:] = cxywh[:, 2:].abs() + 2
+    p_obj = torch.randn(len(owner), 1, generator=g)
+    p_cls = torch.randn(len(owner), nc, generator=g)
+    return cand_b, xywh2xyxy(cxywh), p_obj, p_cls, t_b, xywh2xyxy(txywh * img_size), t_cls, bs
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_simota_assign_matches_reference(seed):
+    batch = random_batch(seed)
+    cand, tind = simota_assign(*batch)
+    cand_ref, tind_ref = simota_reference(*batch)
+    assert len(cand_ref)
+    assert torch.equal(cand, cand_ref)
+    assert torch.equal(tind, tind_ref)
+
+
+def test_simota_assign_without_targets():
+    cand_b, pxyxys, p_obj, p_cls, t_b, txyxy, t_cls, bs = random_batch(0)
+    cand, tind = simota_assign(cand_b, pxyxys, p_obj, p_cls, t_b[:0], txyxy[:0], t_cls[:0], bs)
+    assert cand.shape == tind.shape == (0,)
+    cand, tind = simota_assign(cand_b[:0], pxyxys[:0], p_obj[:0], p_cls[:0], t_b, txyxy, t_cls, bs)
+    assert cand.shape == tind.shape == (0,)
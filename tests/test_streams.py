@@ -0,0 +1,165 @@
+# LoadStreams / StreamReader with local video files standing in for cameras: latest-frame-wins and every-Nth frame
+# delivery, lag and drop counters, streams ending mid-run, reconnecting with backoff and saving late streams
+
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+import utils.datasets as datasets
+from utils.datasets import LoadStreams, VideoWriters
+
+VIDEOS = {'a.mp4': (30, 30, 320, 240), 'b.mp4': (15, 15, 320, 240), 'c.mp4': (10, 20, 160, 120)}  # frames, fps, w, h
+
+
+def level(n):
+    return (n - 1) * 20 % 240  # gray level of frame n (1-based)
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    # a and b play for 1s, c ends after 0.5s. Returns a streams.txt listing them
+    for name, (n, fps, w, h) in VIDEOS.items():
+        vw = cv2.VideoWriter(str(tmp_path / name), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        for i in range(1, n + 1):
+            vw.write(np.full((h, w, 3), level(i), np.uint8))
+        vw.release()
+    f = tmp_path / 'streams.txt'
+    f.write_text(''.join(f'{tmp_path / name}\n' for name in VIDEOS))
+    monkeypatch.setattr(datasets.cv2, 'waitKey', lambda *args: -1)  # no windows
+    return str(f)
+
+
+def run(sources, consumer=0.0, **kwargs):
+    # Iterate LoadStreams to the end, sleeping consumer seconds per batch. Returns the streams of each batch, the frame
+    # numbers delivered per stream and stats()
+    dataset = LoadStreams(sources, img_size=128, stride=32, **kwargs)
+    batches, seen = [], {}
+    for paths, img, img0, _ in dataset:
+        assert img.shape[0] == len(paths) == len(img0) == len(dataset.frames)
+        for p, n, im0 in zip(paths, dataset.frames, img0):
+            assert abs(int(im0[0, 0, 0]) - level(n)) <= 8  # delivered image is frame n
+            seen.setdefault(p[-5:], []).append(n)
+        batches.append([p[-5:] for p in paths])
+        time.sleep(consumer)
+    stats = {x['source'][-5:]: x for x in dataset.stats()}
+    for x in stats.values():
+        assert x['frames'] == x['skipped'] + x['dropped'] + x['delivered']
+        assert not x['alive']
+    return batches, seen, stats
+
+
+def test_latest(sources):
+    # A consumer slower than the streams gets the newest frame of each, the older ones are dropped
+    batches, seen, stats = run(sources, consumer=0.1)
+    for name, (n, fps, w, h) in VIDEOS.items():
+        x = stats[name]
+        assert x['frames'] == n and x['skipped'] == 0 and x['delivered'] == len(seen[name])
+        assert seen[name] == sorted(set(seen[name]))  # newer frames only
+        assert 0 < x['lag'] <= x['lag_max'] < 0.5
+    assert stats['a.mp4']['dropped'] > 0 and stats['b.mp4']['dropped'] > 0
+
+    # c ends mid-run and leaves the batches, a and b go on
+    last = max(i for i, b in enumerate(batches) if 'c.mp4' in b)
+    assert last < len(batches) - 1 and all('a.mp4' in b for b in batches[last + 1:])
+
+
+def test_every_nth(sources):
+    # A fast consumer with a deep buffer gets every 2nd frame of each stream, none dropped
+    batches, seen, stats = run(sources, every=2, latest=False, buffer=64)
+    for name, (n, fps, w, h) in VIDEOS.items():
+        x = stats[name]
+        assert seen[name] == list(range(1, n + 1, 2))
+        assert x['frames'] == n and x['skipped'] == n // 2 and x['dropped'] == 0 and x['delivered'] == (n + 1) // 2
+
+
+def test_fifo_lag(sources):
+    # Oldest-first delivery to a slow consumer lags by up to the buffer and drops frames when it overflows, the
+    # latest-frame-wins consumer does not lag behind
+    _, seen, stats = run(sources, consumer=0.1, latest=False, buffer=4)
+    _, _, latest = run(sources, consumer=0.1)
+    x = stats['a.mp4']
+    assert x['dropped'] > 0 and seen['a.mp4'] == sorted(set(seen['a.mp4']))
+    assert x['lag'] > latest['a.mp4']['lag'] and x['lag_max'] > latest['a.mp4']['lag_max']
+
+
+def test_reconnect(sources, monkeypatch, capsys):
+    # 'cam' is not a file and reconnects: its first capture fails after 10 frames and only the 3rd open succeeds, later
+    # reopens fail until retries are exhausted
+    video, capture, opens = sources.replace('streams.txt', 'a.mp4'), cv2.VideoCapture, []
+
+    class Camera:
+        def __init__(self, url):
+            opens.append(url)
+            self.cap, self.n, self.ok = capture(video), 0, len(opens) in (1, 3)
+
+        def isOpened(self):
+            return self.ok and self.cap.isOpened()
+
+        def grab(self):
+            self.n += 1
+            return self.isOpened() and not (len(opens) == 1 and self.n > 10) and self.cap.grab()
+
+        def retrieve(self):
+            return self.cap.retrieve()
+
+        def read(self):
+            return self.grab(), self.cap.retrieve()[1]
+
+        def get(self, prop):
+            return self.cap.get(prop)
+
+        def release(self):
+            self.cap.release()
+
+    monkeypatch.setattr(datasets.cv2, 'VideoCapture', Camera)
+    t = time.time()
+    dataset = LoadStreams('cam', img_size=128, stride=32, latest=False, buffer=100, retries=3, backoff=0.1)
+    frames = [dataset.frames[0] for _ in dataset]
+    x = dataset.stats()[0]
+
+    assert opens == ['cam'] * 6 and x['reconnects'] == 1 and not x['alive']
+    assert x['frames'] == 10 + VIDEOS['a.mp4'][0] and frames == list(range(1, x['frames'] + 1))
+    waits = [float(s.split('reconnecting in ')[1].split('s')[0]) for s in capsys.readouterr().out.splitlines()
+             if 'reconnecting in' in s]
+    assert waits == [0.1, 0.2, 0.1, 0.2, 0.4]  # backoff doubles, reset by a successful read
+    assert time.time() - t >= sum(waits)
+
+
+def test_late_stream_saved(sources, tmp_path, monkeypatch):
+    # b stalls for a few batches mid-run: it only leaves the batches, its writer stays open and the saved stream keeps
+    # all of its frames (detect.py releases writers of ended() sources only)
+    capture = cv2.VideoCapture
+
+    class Stalling:
+        def __init__(self, url):
+            self.cap, self.n, self.url = capture(url), 0, str(url)
+
+        def grab(self):
+            self.n += 1
+            if self.url.endswith('b.mp4') and self.n == 6:
+                time.sleep(0.4)
+            return self.cap.grab()
+
+        def __getattr__(self, name):
+            return getattr(self.cap, name)
+
+    monkeypatch.setattr(datasets.cv2, 'VideoCapture', Stalling)
+    dataset = LoadStreams(sources, img_size=128, stride=32, latest=False, buffer=64)
+    out, writers, batches = tmp_path / 'out', VideoWriters(), []
+    out.mkdir()
+    for paths, img, img0, _ in dataset:
+        for p, im0 in zip(paths, img0):
+            writers.write(str(out / Path(p).name), im0)
+        writers.release(str(out / Path(p).name) for p in dataset.ended())
+        batches.append([p[-5:] for p in paths])
+    writers.release()
+
+    i = [i for i, b in enumerate(batches) if 'b.mp4' in b]
+    assert len(i) < i[-1] - i[0] + 1  # b was late for some batches
+    for name, (n, fps, w, h) in VIDEOS.items():
+        cap = capture(str(out / f'{name}.mp4'))
+        assert int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == n == sum(name in b for b in batches)
+        cap.release()
@@ -9,7 +9,6 @@ import torch, gc
 
 from copy import deepcopy
 from pathlib import Path
-from threading import Thread
 
 import numpy as np
 import torch.distributed as dist
@@ -28,14 +27,14 @@ import test  # import test.py to get mAP after each epoch
 from models.experimental import attempt_load
 from models.yolo import Model
 from utils.autoanchor import check_anchors
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, augment_batch
 from utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
     fitness, strip_optimizer, get_latest_run, check_dataset, check_file, check_git_status, check_img_size, \
-    check_requirements, print_mutation, set_logging, one_cycle, colorstr
+    check_requirements, set_logging, one_cycle, colorstr, EvolveStore, evolve_hyps
 from utils.google_utils import attempt_download
 from utils.loss import ComputeLoss, ComputeLossOTA
-from utils.plots import plot_images, plot_labels, plot_results, plot_evolution
-from utils.torch_utils import ModelEMA, select_device, intersect_dicts, select_device_wei,torch_distributed_zero_first, is_parallel
+from utils.plots import ImagePlotter, plot_labels, plot_results, plot_evolution
+from utils.torch_utils import ModelEMA, CheckpointWriter, InputStager, select_device, intersect_dicts, select_device_wei,torch_distributed_zero_first, is_parallel
 from utils.wandb_logging.wandb_utils import WandbLogger, check_wandb_resume
 
 #Wei,41-45
@@ -49,7 +48,7 @@ os.environ['TORCH_DISTRIBUTED_DEBUG']='INFO'
 logger = logging.getLogger(__name__)
 
 
-def train(hyp, opt, device, tb_writer=None):
+def train(hyp, opt, device, tb_writer=None, stopper=None):
     #logger.info(colorstr('hyperparameters: ') + ', '.join(f'{k}={v}' for k, v in hyp.items()))
     save_dir, epochs, batch_size, total_batch_size, weights, rank, freeze = \
         Path(opt.save_dir), opt.epochs, opt.batch_size, opt.total_batch_size, opt.weights, opt.global_rank, opt.freeze
@@ -364,6 +363,9 @@ def train(hyp, opt, device, tb_writer=None):
                 f'Logging results to {save_dir}\n'
                 f'Starting training for {epochs} epochs...')
     torch.save(model, wdir / 'init.pt')
+    ckpt_writer = CheckpointWriter()  # epoch checkpoints are written in the background
+    plotter = ImagePlotter()  # renders train_batch*.jpg in the background
+    stager = InputStager(device)  # uploads the next batch while the previous one is still computing
     """
     torch.cuda.memory_summary(device=0, abbreviated=False)
     gc.collect()
@@ -405,7 +407,10 @@ def train(hyp, opt, device, tb_writer=None):
             #targets.to(device)
             #print("\n375 targets.device",targets.device)
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            imgs = stager(imgs, normalize=not opt.batch_augment)  # uint8 to float32, 0-255 to 0.0-1.0
+            if opt.batch_augment:  # mixup, HSV and flips on the whole batch
+                imgs, targets = augment_batch(imgs, targets, hyp)
+                imgs = imgs.float() / 255.0
 
             # Warmup
             if ni <= nw:
@@ -477,11 +482,12 @@ def train(hyp, opt, device, tb_writer=None):
                 # Plot
                 if plots and ni < 10:
                     f = save_dir / f'train_batch{ni}.jpg'  # filename
-                    Thread(target=plot_images, args=(imgs, targets, paths, f), daemon=True).start()
+                    plotter(imgs, targets, paths, f, normalized=True)  # imgs are 0.0 - 1.0 either way
                     # if tb_writer:
                     #     tb_writer.add_image(f, result, dataformats='HWC', global_step=epoch)
                     #     tb_writer.add_graph(torch.jit.trace(model, imgs, strict=False), [])  # add model graph
                 elif plots and ni == 10 and wandb_logger.wandb:
+                    plotter.join()
                     wandb_logger.log({"Mosaics": [wandb_logger.wandb.Image(str(x), caption=x.name) for x in save_dir.glob('train*.jpg') if x.exists()]})
 
             # end batch ------------------------------------------------------------------------------------------------
@@ -499,7 +505,8 @@ def train(hyp, opt, device, tb_writer=None):
             #ema.update(model)
             #print(ema.ema.names)
             final_epoch = epoch + 1 == epochs
-            if not opt.notest or final_epoch:  # Calculate mAP
+            early_epoch = stopper is not None and epoch + 1 == stopper.epoch  # --evolve-stop check
+            if not opt.notest or final_epoch or early_epoch:  # Calculate mAP
                 wandb_logger.current_epoch = epoch + 1
 
                 #print("\nweiImg",len(weiImg),weiImg[0].size())
@@ -554,33 +561,42 @@ def train(hyp, opt, device, tb_writer=None):
                 ckpt = {'epoch': epoch,
                         'best_fitness': best_fitness,
                         'training_results': results_file.read_text(),
-                        'model': deepcopy(model.module if is_parallel(model) else model).half(),
-                        'ema': deepcopy(ema.ema).half(),
+                        'model': model.module if is_parallel(model) else model,  # FP16 snapshot by ckpt_writer
+                        'ema': ema.ema,
                         'updates': ema.updates,
                         'optimizer': optimizer.state_dict(),
                         'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
 
-                # Save last, best and delete
-                torch.save(ckpt, last)
+                # Save last, best and delete, serialized once in the background and linked to the other names
+                paths = [last]
                 if best_fitness == fi:
-                    torch.save(ckpt, best)
+                    paths.append(best)
                 if (best_fitness == fi) and (epoch >= 200):
-                    torch.save(ckpt, wdir / 'best_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'best_{:03d}.pt'.format(epoch))
                 if epoch == 0:
-                    torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'epoch_{:03d}.pt'.format(epoch))
                 elif ((epoch+1) % 25) == 0:
-                    torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'epoch_{:03d}.pt'.format(epoch))
                 elif epoch >= (epochs-5):
-                    torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'epoch_{:03d}.pt'.format(epoch))
+                ckpt_writer.save(ckpt, paths)
                 if wandb_logger.wandb:
                     if ((epoch + 1) % opt.save_period == 0 and not final_epoch) and opt.save_period != -1:
+                        ckpt_writer.wait()
                         wandb_logger.log_model(
                             last.parent, opt, epoch, fi, best_model=best_fitness == fi)
                 del ckpt
 
+            # Stop unpromising --evolve candidates
+            if early_epoch and not final_epoch and stopper(fi):
+                logger.info(f'Stopping --evolve candidate after {epoch + 1} epochs, fitness {stopper.fitness:.4g}')
+                break
+
         # end epoch ----------------------------------------------------------------------------------------------------
     # end training
     if rank in [-1, 0]:
+        ckpt_writer.wait()  # last checkpoint written
+        plotter.close()
         # Plots
         if plots:
             plot_results(save_dir=save_dir)  # save as results.png
@@ -624,6 +640,20 @@ def train(hyp, opt, device, tb_writer=None):
     return results
 
 
+def evolve_candidate(i, hyp, opt, device, threads, stopper, results_queue):
+    # Train --evolve candidate i in its own process, puts (i, hyp, results, epochs trained, early fitness, error)
+    set_logging()
+    try:
+        if threads:
+            torch.set_num_threads(threads)
+        device = select_device(device, batch_size=opt.batch_size)
+        results = train(hyp.copy(), opt, device, stopper=stopper)
+        epochs = stopper.epoch if stopper and stopper.stopped else opt.epochs
+        results_queue.put((i, hyp, tuple(results[0]), epochs, stopper.fitness if stopper else float('nan'), None))
+    except Exception as e:
+        results_queue.put((i, hyp, None, 0, 0, repr(e)))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default='', help='initial weights path')
@@ -638,9 +668,11 @@ if __name__ == '__main__':
     parser.add_argument('--nosave', action='store_true', help='only save final checkpoint')
     parser.add_argument('--notest', action='store_true', help='only test final epoch')
     parser.add_argument('--noautoanchor', action='store_true', help='disable autoanchor check')
-    parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
+    parser.add_argument('--evolve', type=int, nargs='?', const=300, help='evolve hyperparameters for x candidates')
+    parser.add_argument('--evolve-workers', type=int, default=1, help='--evolve candidates trained at once, each in its own process on its own device')
+    parser.add_argument('--evolve-stop', type=int, default=0, help='stop --evolve candidates below the median fitness after this many epochs (0 to disable)')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache-images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache-images', type=str, nargs='?', const='ram', help='cache images in "ram" (default) or "disk" (memory-mapped) for faster training')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--multi-scale', action='store_true', help='vary img-size +/- 50%%')
@@ -654,6 +686,8 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--quad', action='store_true', help='quad dataloader')
+    parser.add_argument('--batch-augment', action='store_true', help='HSV, flip and mixup augmentation on whole batches')
+    parser.add_argument('--fused-mosaic', action='store_true', help='render affine mosaics straight into the warped image (faster, differs at tile seams)')
     parser.add_argument('--linear-lr', action='store_true', help='linear LR')
     parser.add_argument('--label-smoothing', type=float, default=0.0, help='Label smoothing epsilon')
     parser.add_argument('--upload_dataset', action='store_true', help='Upload dataset as W&B artifact table')
@@ -688,7 +722,7 @@ if __name__ == '__main__':
         assert len(opt.cfg) or len(opt.weights), 'either --cfg or --weights must be specified'
         opt.img_size.extend([opt.img_size[-1]] * (2 - len(opt.img_size)))  # extend to 2 sizes (train, test)
         opt.name = 'evolve' if opt.evolve else opt.name
-        opt.save_dir = increment_path(Path(opt.project) / opt.name, exist_ok=opt.exist_ok | opt.evolve)  # increment run
+        opt.save_dir = increment_path(Path(opt.project) / opt.name, exist_ok=opt.exist_ok | bool(opt.evolve))  # increment run
 
     # DDP mode
     opt.total_batch_size = opt.batch_size
@@ -760,44 +794,9 @@ if __name__ == '__main__':
         yaml_file = Path(opt.save_dir) / 'hyp_evolved.yaml'  # save best result here
         if opt.bucket:
             os.system('gsutil cp gs://%s/evolve.txt .' % opt.bucket)  # download evolve.txt if exists
+        store = EvolveStore('evolve.txt', opt.bucket)  # shared with other evolve runs on the same file
 
-        for _ in range(300):  # generations to evolve
-            if Path('evolve.txt').exists():  # if evolve.txt exists: select best hyps and mutate
-                # Select parent(s)
-                parent = 'single'  # parent selection method: 'single' or 'weighted'
-                x = np.loadtxt('evolve.txt', ndmin=2)
-                n = min(5, len(x))  # number of previous results to consider
-                x = x[np.argsort(-fitness(x))][:n]  # top n mutations
-                w = fitness(x) - fitness(x).min()  # weights
-                if parent == 'single' or len(x) == 1:
-                    # x = x[random.randint(0, n - 1)]  # random selection
-                    x = x[random.choices(range(n), weights=w)[0]]  # weighted selection
-                elif parent == 'weighted':
-                    x = (x * w.reshape(n, 1)).sum(0) / w.sum()  # weighted combination
-
-                # Mutate
-                mp, s = 0.8, 0.2  # mutation probability, sigma
-                npr = np.random
-                npr.seed(int(time.time()))
-                g = np.array([x[0] for x in meta.values()])  # gains 0-1
-                ng = len(meta)
-                v = np.ones(ng)
-                while all(v == 1):  # mutate until a change occurs (prevent duplicates)
-                    v = (g * (npr.random(ng) < mp) * npr.randn(ng) * npr.random() * s + 1).clip(0.3, 3.0)
-                for i, k in enumerate(hyp.keys()):  # plt.hist(v.ravel(), 300)
-                    hyp[k] = float(x[i + 7] * v[i])  # mutate
-
-            # Constrain to limits
-            for k, v in meta.items():
-                hyp[k] = max(hyp[k], v[1])  # lower limit
-                hyp[k] = min(hyp[k], v[2])  # upper limit
-                hyp[k] = round(hyp[k], 5)  # significant digits
-
-            # Train mutation
-            results = train(hyp.copy(), opt, device)
-
-            # Write mutation results
-            print_mutation(hyp.copy(), results, yaml_file, opt.bucket)
+        evolve_hyps(hyp, meta, opt, store, evolve_candidate, yaml_file)
 
         # Plot results
         plot_evolution(yaml_file)
@@ -1,5 +1,7 @@
 # Auto-anchor utils
 
+import math
+
 import numpy as np
 import torch
 import yaml
@@ -8,6 +10,8 @@ from tqdm import tqdm
 
 from utils.general import colorstr
 
+n_att=4
+
 
 def check_anchor_order(m):
     # Check anchor order against stride order for YOLO Detect() module m, and correct if necessary
@@ -25,9 +29,8 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     prefix = colorstr('autoanchor: ')
     print(f'\n{prefix}Analyzing anchors... ', end='')
     m = model.module.model[-1] if hasattr(model, 'module') else model.model[-1]  # Detect()
-    shapes = imgsz * dataset.shapes / dataset.shapes.max(1, keepdims=True)
-    scale = np.random.uniform(0.9, 1.1, size=(shapes.shape[0], 1))  # augment scale
-    wh = torch.tensor(np.concatenate([l[:, 4:6] * s for s, l in zip(shapes * scale, dataset.labels)])).float()  # wh
+    scale = np.random.uniform(0.9, 1.1, size=(len(dataset.shapes), 1))  # augment scale
+    wh = torch.tensor(label_wh(dataset, imgsz, scale)).float()  # wh
 
     def metric(k):  # compute metric
         r = wh[:, None] / k[None]
@@ -44,7 +47,7 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
         print('. Attempting to improve anchors, please wait...')
         na = m.anchor_grid.numel() // 2  # number of anchors
         try:
-            anchors = kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False)
+            anchors = kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False, nl=m.nl)
             #
             # pass
         except Exception as e:
@@ -61,7 +64,21 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     print('')  # newline
 
 
-def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True):
+def label_wh(dataset, img_size, scale=None):
+    # Label wh in pixels for images resized to img_size (optionally times a per-image scale), shape (n, 2)
+    shapes = img_size * dataset.shapes / dataset.shapes.max(1, keepdims=True)
+    if scale is not None:
+        shapes = shapes * scale
+    labels = dataset.labels
+    if hasattr(labels, 'starts'):  # RaggedRows, gathered from the shared values array without a per-image loop
+        n = labels.ends - labels.starts
+        i = np.repeat(labels.starts - (np.cumsum(n) - n), n) + np.arange(n.sum())
+        return labels.values[i, n_att + 2:n_att + 4] * np.repeat(shapes, n, 0)
+    return np.concatenate([l[:, n_att + 2:n_att + 4] * s for s, l in zip(shapes, labels)])
+
+
+def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True, nl=1, pop=8,
+                  max_labels=100000):
     """ Creates kmeans-evolved anchors from training dataset
 
         Arguments:
@@ -69,8 +86,11 @@ def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000,
             n: number of anchors
             img_size: image size used for training
             thr: anchor-label wh ratio threshold hyperparameter hyp['anchor_t'] used for training, default=4.0
-            gen: generations to evolve anchors using genetic algorithm
+            gen: candidate anchor sets to evaluate using genetic algorithm
             verbose: print all results
+            nl: number of detection layers, n // nl anchors each, each candidate mutates the anchors of one layer
+            pop: candidate anchor sets evaluated together per generation (gen / pop generations)
+            max_labels: kmeans on a random subset of at most this many labels
 
         Return:
             k: kmeans evolved anchors
@@ -87,9 +107,13 @@ def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000,
         # x = wh_iou(wh, torch.tensor(k))  # iou metric
         return x, x.max(1)[0]  # x, best_x
 
-    def anchor_fitness(k):  # mutation fitness
-        _, best = metric(torch.tensor(k, dtype=torch.float32), wh)
-        return (best * (best > thr).float()).mean()  # fitness
+    def anchor_fitness(k):  # mutation fitness of a population of anchor sets (p, n, 2), one batched op per chunk
+        k = torch.tensor(np.log(k), dtype=torch.float32)
+        f = []
+        for kc in k.split(max(2 ** 20 // (len(wh) * n), 1)):  # ratio metric is exp(-max |log wh - log k|)
+            d = (wh[:, None] - kc[:, None]).abs_().max(-1)[0].min(-1)[0]  # -log best_x (p, labels)
+            f.append((d < -math.log(thr)).float().mul_(torch.exp(-d)) @ w)
+        return torch.cat(f).numpy() / w.sum().item()  # fitness, label (bin) weighted mean
 
     def print_results(k):
         k = k[np.argsort(k.prod(1))]  # sort small to large
@@ -111,8 +135,7 @@ def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000,
         dataset = path  # dataset
 
     # Get label wh
-    shapes = img_size * dataset.shapes / dataset.shapes.max(1, keepdims=True)
-    wh0 = np.concatenate([l[:, 3:5] * s for s, l in zip(shapes, dataset.labels)])  # wh
+    wh0 = label_wh(dataset, img_size)  # wh
 
     # Filter
     i = (wh0 < 3.0).any(1).sum()
@@ -122,12 +145,18 @@ def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000,
     # wh = wh * (np.random.rand(wh.shape[0], 1) * 0.9 + 0.1)  # multiply by random scale 0-1
 
     # Kmeans calculation
-    print(f'{prefix}Running kmeans for {n} anchors on {len(wh)} points...')
-    s = wh.std(0)  # sigmas for whitening
-    k, dist = kmeans(wh / s, n, iter=30)  # points, mean distance
+    x = wh[np.random.choice(len(wh), max_labels, replace=False)] if len(wh) > max_labels else wh  # subset
+    print(f'{prefix}Running kmeans for {n} anchors on {len(x)} points...')
+    s = x.std(0)  # sigmas for whitening
+    k, dist = kmeans(x / s, n, iter=30)  # points, mean distance
     assert len(k) == n, print(f'{prefix}ERROR: scipy.cluster.vq.kmeans requested {n} points but returned only {len(k)}')
     k *= s
-    wh = torch.tensor(wh, dtype=torch.float32)  # filtered
+    wh, w = np.log(wh), np.ones(len(wh))  # log wh, label weights
+    x, c = np.unique(np.round(wh * (32 / math.log(2))), axis=0, return_counts=True)  # 1/32 octave bins
+    if len(x) < len(wh) / 2:  # evolve on bins (<1.1% ratio error) weighted by label count
+        wh, w = x * (math.log(2) / 32), c
+    wh = torch.tensor(wh, dtype=torch.float32)  # filtered, log
+    w = torch.tensor(w, dtype=torch.float32)  # label weights
     wh0 = torch.tensor(wh0, dtype=torch.float32)  # unfiltered
     k = print_results(k)
 
@@ -145,16 +174,17 @@ def kmean_anchors(path='./data/coco.yaml', n=9, img_size=640, thr=4.0, gen=1000,
 
     # Evolve
     npr = np.random
-    f, sh, mp, s = anchor_fitness(k), k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
-    pbar = tqdm(range(gen), desc=f'{prefix}Evolving anchors with Genetic Algorithm:')  # progress bar
+    f, sh, mp, s = anchor_fitness(k[None])[0], (pop, *k.shape), 0.9, 0.1  # fitness, generations, mutation prob, sigma
+    layer = np.arange(n) // max(n // nl, 1)  # detection layer of each anchor
+    pbar = tqdm(range(math.ceil(gen / pop)), desc=f'{prefix}Evolving anchors with Genetic Algorithm:')  # progress bar
     for _ in pbar:
-        v = np.ones(sh)
-        while (v == 1).all():  # mutate until a change occurs (prevent duplicates)
-            v = ((npr.random(sh) < mp) * npr.random() * npr.randn(*sh) * s + 1).clip(0.3, 3.0)
-        kg = (k.copy() * v).clip(min=2.0)
+        v = ((npr.random(sh) < mp) * npr.random((pop, 1, 1)) * npr.randn(*sh) * s + 1).clip(0.3, 3.0)
+        v[layer != npr.randint(nl, size=(pop, 1))] = 1.0  # mutate one detection layer per candidate
+        kg = (k * v).clip(min=2.0)
         fg = anchor_fitness(kg)
-        if fg > f:
-            f, k = fg, kg.copy()
+        i = fg.argmax()
+        if fg[i] > f:
+            f, k = fg[i], kg[i][np.argsort(kg[i].prod(1))]  # sorted small to large, grouped by layer
             pbar.desc = f'{prefix}Evolving anchors with Genetic Algorithm: fitness = {f:.4f}'
             if verbose:
                 print_results(k)
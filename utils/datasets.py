@@ -1,16 +1,22 @@
 # Dataset utils and dataloaders
 
 import glob
+import hashlib
+import io
 import logging
 import math
 import os
+import queue
 import random
 import shutil
+import struct
 import time
+import zipfile
+from collections import OrderedDict, deque
 from itertools import repeat
-from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Lock, Thread
 
 import cv2
 import numpy as np
@@ -21,13 +27,13 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 
 import pickle
-from copy import deepcopy
+from copy import copy, deepcopy
 #from pycocotools import mask as maskUtils
 from torchvision.utils import save_image
 from torchvision.ops import roi_pool, roi_align, ps_roi_pool, ps_roi_align
 
 from utils.general import check_requirements, xyxy2xywh, xywh2xyxy, xywhn2xyxy, xyn2xy, segment2box, segments2boxes, \
-    resample_segments, clean_str
+    resample_segments, clean_str, Diagnostics
 from utils.torch_utils import torch_distributed_zero_first
 
 n_att=4
@@ -36,7 +42,11 @@ n_att=4
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
 vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+num_threads = min(8, os.cpu_count())  # number of multiprocessing threads
+cache_version = 0.3  # label cache version, columnar arrays keyed by per-file (size, mtime)
+mmap_keys = ('label_offsets', 'labels', 'segment_offsets', 'point_offsets', 'points')  # memory-mapped cache arrays
 logger = logging.getLogger(__name__)
+diag = Diagnostics(__name__)
 
 # Get orientation exif tag
 for orientation in ExifTags.TAGS.keys():
@@ -77,7 +87,9 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      batch_augment=getattr(opt, 'batch_augment', False),
+                                      fused_mosaic=getattr(opt, 'fused_mosaic', False))
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
@@ -128,7 +140,9 @@ class _RepeatSampler(object):
 
 
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, stride=32):
+    state_keys = 'count', 'frame', 'nframes', 'mode', 'desc'  # iteration state of a read item
+
+    def __init__(self, path, img_size=640, stride=32, workers=0, prefetch=8):
         p = str(Path(path).absolute())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -149,6 +163,10 @@ class LoadImages:  # for inference
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
+        self.desc = ''  # progress of the current frame
+        self.workers, self.prefetch = workers, prefetch  # decode threads, bounded read-ahead (items)
+        self.pool, self.opened = None, []  # decode thread pool, video captures opened
+        self.buffers = BatchBuffers(prefetch + workers + 2 if workers else 2)  # letterbox outputs, reused
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -158,9 +176,29 @@ class LoadImages:  # for inference
 
     def __iter__(self):
         self.count = 0
+        if self.workers:  # decode and letterbox ahead in a thread pool, items come out in order
+            self.reader = copy(self)  # reading state
+            self.queue = queue.Queue(self.prefetch)  # bounded, the reader waits for the consumer
+            Thread(target=self.reader.read_ahead, args=(self.queue,), daemon=True).start()
         return self
 
     def __next__(self):
+        if not self.workers:
+            return self.load(*self.read())
+        x = self.queue.get()
+        if x is None:
+            for cap in self.opened:  # kept open until all their frames are consumed
+                cap.release()
+            raise StopIteration
+        if isinstance(x, Exception):
+            raise x
+        state, x = x
+        for k, v in zip(self.state_keys, state):
+            setattr(self, k, v)
+        return x.get()
+
+    def read(self):
+        # Next image path or video frame, in order
         if self.count == self.nf:
             raise StopIteration
         path = self.files[self.count]
@@ -171,7 +209,8 @@ class LoadImages:  # for inference
             ret_val, img0 = self.cap.read()
             if not ret_val:
                 self.count += 1
-                self.cap.release()
+                if not self.workers:
+                    self.cap.release()
                 if self.count == self.nf:  # last video
                     raise StopIteration
                 else:
@@ -180,33 +219,152 @@ class LoadImages:  # for inference
                     ret_val, img0 = self.cap.read()
 
             self.frame += 1
-            print(f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: ', end='')
+            self.desc = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: '
 
         else:
-            # Read image
+            # Image, read by load()
             self.count += 1
+            img0 = None
+        return path, img0, self.cap
+
+    def load(self, path, img0, cap):
+        img, img0 = self.letterbox(path, img0)
+        return path, img, img0, cap
+
+    def letterbox(self, path, img0, out=None):
+        # Letterboxed CHW RGB image and BGR original, read from path if img0 is None. The image is written into out, a
+        # slice of a batch buffer, or into the next buffer at the minimum stride-multiple shape
+        if img0 is None:
             img0 = cv2.imread(path)  # BGR
             assert img0 is not None, 'Image Not Found ' + path
-            #print(f'image {self.count}/{self.nf} {path}: ', end='')
 
         # Padded resize
-        img = letterbox(img0, self.img_size, stride=self.stride)[0]
+        if out is None:
+            out = self.buffers.get((3, *letterbox_shape(img0.shape[:2], self.img_size, self.stride)))
+            letterbox_into(img0, out, self.img_size)
+        else:
+            letterbox_into(img0, out)
+        return out, img0
 
-        # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
+    def submit(self, x):
+        # Schedule load(*x) on the pool, returns an AsyncResult
+        return self.pool.apply_async(self.load, x)
 
-        return path, img, img0, self.cap
+    def read_ahead(self, q):
+        # Reader thread, queues (state, pending load) per item, then None
+        self.pool = ThreadPool(self.workers)
+        try:
+            while True:
+                try:
+                    x = self.read()
+                except StopIteration:
+                    break
+                q.put((tuple(getattr(self, k, 0) for k in self.state_keys), self.submit(x)))
+        except Exception as e:
+            q.put(e)
+        q.put(None)
+        self.pool.close()
 
     def new_video(self, path):
         self.frame = 0
         self.cap = cv2.VideoCapture(path)
         self.nframes = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.opened.append(self.cap)
 
     def __len__(self):
         return self.nf  # number of files
 
 
+class LoadImageBatches(LoadImages):  # for batched inference
+    # Yields (paths, imgs, img0s, caps) batches of a common letterbox shape as LoadStreams does. Images are bucketed by
+    # aspect ratio as in rectangular training, then groups of batch_size videos are decoded side by side, one frame of
+    # each per batch. desc, frames and nframes hold one entry per batch image
+    state_keys = 'count', 'frames', 'nframes', 'mode', 'desc'
+
+    def __init__(self, path, img_size=640, stride=32, batch_size=8, workers=0, prefetch=8):
+        super().__init__(path, img_size, stride, workers, prefetch)
+        for cap in self.opened:
+            cap.release()
+        self.cap, self.opened, self.group = None, [], None
+
+        ni = self.video_flag.count(False)
+        ar = np.array([image_aspect_ratio(f) for f in self.files[:ni]])
+        i = ar.argsort()  # sort by aspect ratio
+        self.plan = [(i[j:j + batch_size], rect_shape(ar[i[j:j + batch_size]], img_size, stride))
+                     for j in range(0, ni, batch_size)]  # (files, shape) of each batch
+        self.plan += [(np.arange(j, min(j + batch_size, self.nf)), None) for j in range(ni, self.nf, batch_size)]
+        self.nb = len(self.plan)  # number of image batches and video groups
+
+    def read(self):
+        # Next batch paths, frames (None for images), captures and letterbox shape
+        if self.count == self.nb:
+            raise StopIteration
+        files, shape = self.plan[self.count]
+        paths = [self.files[i] for i in files]
+
+        if not self.video_flag[files[0]]:
+            self.count += 1
+            self.mode, self.desc = 'image', [''] * len(paths)
+            self.frames = self.nframes = [0] * len(paths)
+            return paths, [None] * len(paths), [None] * len(paths), shape
+
+        # Videos decoded side by side
+        self.mode = 'video'
+        if self.group is not files:  # new video group
+            self.group, self.caps = files, []
+            for f in paths:
+                self.new_video(f)
+                self.caps.append(self.cap)
+            self.shape, self.counts = None, np.zeros((2, len(paths)), dtype=int)  # frames read, frames per video
+            self.counts[1] = [c.get(cv2.CAP_PROP_FRAME_COUNT) for c in self.caps]
+        img0s = list((self.pool.map if self.pool else map)(lambda c: c.read()[1] if c.isOpened() else None, self.caps))
+        j = [k for k, x in enumerate(img0s) if x is not None]  # videos with frames left
+        for k, c in enumerate(self.caps):
+            if img0s[k] is None and c.isOpened() and not self.workers:
+                c.release()
+        if not j:  # group done
+            self.count += 1
+            return self.read()
+        if self.shape is None:
+            self.shape = rect_shape(np.array([x.shape[0] / x.shape[1] for x in img0s if x is not None]),
+                                    self.img_size, self.stride)
+        self.counts[0, j] += 1
+        self.frames, self.nframes = self.counts[:, j].tolist()
+        self.desc = [f'video {files[k] + 1}/{self.nf} ({self.counts[0, k]}/{self.counts[1, k]}) {paths[k]}: ' for k in j]
+        return [paths[k] for k in j], [img0s[k] for k in j], [self.caps[k] for k in j], self.shape
+
+    def load(self, paths, img0s, caps, shape):
+        img = self.buffers.get((len(paths), 3, *shape))
+        return paths, img, [self.letterbox(*x)[1] for x in zip(paths, img0s, img)], caps
+
+    def submit(self, x):
+        # Letterbox the images of a batch into its buffer in parallel, collected by a later pool task (no deadlock as
+        # the pool is FIFO)
+        paths, img0s, caps, shape = x
+        img = self.buffers.get((len(paths), 3, *shape))
+        loaded = self.pool.starmap_async(self.letterbox, zip(paths, img0s, img))
+        return self.pool.apply_async(lambda: (paths, img, [x[1] for x in loaded.get()], caps))
+
+    def __len__(self):
+        return self.nb  # number of batches of images, groups of videos
+
+
+def image_aspect_ratio(path):
+    # Height / width of an image from its header, 1.0 if unreadable (reported when loading)
+    try:
+        w, h = exif_size(Image.open(path))
+        return h / w
+    except Exception:
+        return 1.0
+
+
+def rect_shape(ar, img_size=640, stride=32, pad=0.0):
+    # Letterbox (h, w) of a batch of images with aspect ratios ar (h / w), as in rectangular training
+    mini, maxi = ar.min(), ar.max()
+    shape = [maxi, 1] if maxi < 1 else [1, 1 / mini] if mini > 1 else [1, 1]
+    return np.ceil(np.array(shape) * img_size / stride + pad).astype(int) * stride
+
+
 class LoadWebcam:  # for inference
     def __init__(self, pipe='0', img_size=640, stride=32):
         self.img_size = img_size
@@ -265,59 +423,149 @@ class LoadWebcam:  # for inference
         return 0
 
 
+class StreamReader:  # one camera of LoadStreams
+    # Reads frames in a daemon thread into a ring buffer of (capture time, frame number, letterboxed CHW RGB image, BGR
+    # original), the images letterboxed into buffer + 1 reused slots. Only every stride-th frame is decoded, the others
+    # are grabbed and skipped. Failed reads reconnect with exponential backoff. Local video files stand in for cameras:
+    # they are paced to their FPS and end at the last frame
+    def __init__(self, source, stride=32, every=1, buffer=4, retries=5, backoff=0.5, cond=None):
+        url = eval(source) if source.isnumeric() else source
+        if 'youtube.com/' in str(url) or 'youtu.be/' in str(url):  # if source is YouTube video
+            check_requirements(('pafy', 'youtube_dl'))
+            import pafy
+            url = pafy.new(url).getbest(preftype="mp4").url
+        self.source, self.url, self.file = source, url, os.path.isfile(str(url))
+        self.stride, self.every, self.retries, self.backoff = stride, every, retries, backoff
+        self.ring = deque(maxlen=buffer)
+        self.cond = cond or Condition()  # guards the ring and metrics, notified on every new frame and on stream end
+        self.alive = True  # False once the stream ended or was closed
+        self.frames = self.skipped = self.dropped = self.delivered = self.reconnects = 0
+        self.lag = self.lag_max = 0.0  # summed and maximum seconds from capture to delivery
+        self.t0 = 0.0  # start of reading, files are paced from it
+
+        self.cap = cv2.VideoCapture(url)
+        assert self.cap.isOpened(), f'Failed to open {source}'
+        self.w = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) % 100 or 30.0
+        ok, self.img0 = self.cap.read()  # guarantee first frame
+        assert ok, f'Failed to read {source}'
+        self.t = time.time()
+
+    def start(self, shape):
+        # Letterbox frames to shape (h, w) from now on and start reading
+        self.shape = shape
+        self.slots = [np.empty((3, *shape), dtype=np.uint8) for _ in range(self.ring.maxlen + 1)]  # free slots
+        self.put(self.t, 1, self.img0)
+        self.frames, self.t0 = 1, time.time()
+        Thread(target=self.update, daemon=True).start()
+
+    def update(self):
+        # Read next stream frames in a daemon thread
+        k = 0  # failed reads in a row
+        while self.alive:
+            if self.file:  # a file plays at its frame rate, as a camera would deliver it
+                time.sleep(max(0.0, self.t0 + self.frames / self.fps - time.time()))
+            ok = self.cap.grab()
+            t = time.time()  # capture time
+            if ok:
+                self.frames += 1
+                if (self.frames - 1) % self.every:  # frames 1, 1 + every, ...
+                    self.skipped += 1
+                    continue
+                ok, img0 = self.cap.retrieve()
+            if ok:
+                k = 0
+                self.put(t, self.frames, img0)
+                continue
+
+            self.cap.release()
+            if self.file or k == self.retries:  # end of file or reconnecting failed
+                break
+            wait = self.backoff * 2 ** k
+            print(f'WARNING: stream {self.source} read failed, reconnecting in {wait:g}s ({k + 1}/{self.retries})')
+            time.sleep(wait)
+            k += 1
+            self.cap = cv2.VideoCapture(self.url)
+            self.reconnects += self.cap.isOpened()
+        self.cap.release()
+        with self.cond:
+            self.alive = False
+            self.cond.notify_all()
+
+    def put(self, t, n, img0):
+        with self.cond:
+            if len(self.ring) == self.ring.maxlen:  # drop the oldest frame
+                self.slots.append(self.ring.popleft()[2])
+                self.dropped += 1
+            img = self.slots.pop()
+        letterbox_into(img0, img)
+        with self.cond:
+            self.ring.append((t, n, img, img0))
+            self.cond.notify_all()
+
+    def take(self, out, latest=True):
+        # Copy the newest buffered frame into out, dropping the older ones, or the oldest one. Returns its capture time,
+        # frame number and original. Call with cond held and the ring not empty
+        if latest:
+            x = self.ring.pop()
+            self.slots += [y[2] for y in self.ring]
+            self.dropped += len(self.ring)
+            self.ring.clear()
+        else:
+            x = self.ring.popleft()
+        out[:] = x[2]
+        self.slots.append(x[2])
+        lag = time.time() - x[0]
+        self.delivered += 1
+        self.lag += lag
+        self.lag_max = max(self.lag_max, lag)
+        return x[0], x[1], x[3]
+
+    def stats(self):
+        return {'source': self.source, 'frames': self.frames, 'skipped': self.skipped, 'dropped': self.dropped,
+                'delivered': self.delivered, 'reconnects': self.reconnects,
+                'lag': self.lag / max(self.delivered, 1), 'lag_max': self.lag_max, 'alive': self.alive}
+
+
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    # Each source is read by a StreamReader thread. A batch holds one new frame of each stream that has one, waiting up
+    # to `wait` seconds for the others once the first is in: the latest frame (latest-frame-wins, older ones are dropped)
+    # or, with latest=False, the oldest buffered one, so every stride-th frame is processed unless the buffer overflows.
+    # Streams that ended leave the batches. paths, desc and frames list the streams of the current batch
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, every=1, latest=True, buffer=4, retries=5,
+                 backoff=0.5, wait=0.05):
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.latest, self.wait = latest, wait
 
-        if os.path.isfile(sources):
+        if os.path.isfile(sources) and sources.endswith('.txt'):
             with open(sources, 'r') as f:
                 sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip())]
         else:
             sources = [sources]
 
         n = len(sources)
-        self.imgs = [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.cond = Condition()  # shared by all streams
+        self.streams = []
         for i, s in enumerate(sources):
-            # Start the thread to read frames from the video stream
+            # Open the stream, reading starts once the letterbox shape is known
             print(f'{i + 1}/{n}: {s}... ', end='')
-            url = eval(s) if s.isnumeric() else s
-            if 'youtube.com/' in str(url) or 'youtu.be/' in str(url):  # if source is YouTube video
-                check_requirements(('pafy', 'youtube_dl'))
-                import pafy
-                url = pafy.new(url).getbest(preftype="mp4").url
-            cap = cv2.VideoCapture(url)
-            assert cap.isOpened(), f'Failed to open {s}'
-            w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
-
-            _, self.imgs[i] = cap.read()  # guarantee first frame
-            thread = Thread(target=self.update, args=([i, cap]), daemon=True)
-            print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
-            thread.start()
+            self.streams.append(StreamReader(s, stride, every, buffer, retries, backoff, self.cond))
+            print(f' success ({self.streams[-1].w}x{self.streams[-1].h} at {self.streams[-1].fps:.2f} FPS).')
         print('')  # newline
 
         # check for common shapes
-        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for x in self.imgs], 0)  # shapes
+        s = np.stack([letterbox(x.img0, self.img_size, stride=self.stride)[0].shape for x in self.streams], 0)  # shapes
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
-
-    def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
-        while cap.isOpened():
-            n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                success, im = cap.retrieve()
-                self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+        self.shape = tuple(s[0, :2]) if self.rect else (img_size, img_size)
+        self.buffers = BatchBuffers(2)  # batches, reused
+        for x in self.streams:
+            x.start(self.shape)
 
     def __iter__(self):
         self.count = -1
@@ -325,25 +573,61 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
         if cv2.waitKey(1) == ord('q'):  # q to quit
+            self.close()
             cv2.destroyAllWindows()
             raise StopIteration
 
-        # Letterbox
-        img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
+        streams = self.streams
+        with self.cond:
+            self.cond.wait_for(lambda: any(x.ring for x in streams) or not any(x.alive for x in streams))
+            self.cond.wait_for(lambda: all(x.ring or not x.alive for x in streams), self.wait)
+            i = [j for j, x in enumerate(streams) if x.ring]
+            if not i:  # all streams ended
+                raise StopIteration
+            img = self.buffers.get((len(i), 3, *self.shape))
+            t, frames, img0 = zip(*(streams[j].take(out, self.latest) for j, out in zip(i, img)))
+
+        self.desc, self.frames = [f'{j}: ' for j in i], list(frames)
+        return [self.sources[j] for j in i], img, list(img0), [None] * len(i)
+
+    def stats(self):
+        # Per stream: frames grabbed, skipped (stride), dropped (buffer overflow or superseded), delivered, reconnects,
+        # mean and max seconds from capture to delivery, and whether it is still read
+        with self.cond:
+            return [x.stats() for x in self.streams]
+
+    def ended(self):
+        # Sources of the streams that ended and have no frames left, a stream missing from a batch may only be late
+        with self.cond:
+            return [s for s, x in zip(self.sources, self.streams) if not (x.alive or x.ring)]
+
+    def close(self):
+        # Stop the reader threads, they release their captures
+        for x in self.streams:
+            x.alive = False
 
-        # Stack
-        img = np.stack(img, 0)
+    def __len__(self):
+        return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
-        # Convert
-        img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x416x416
-        img = np.ascontiguousarray(img)
 
-        return self.sources, img, img0, None
+class VideoWriters:  # saved videos and streams, one cv2.VideoWriter per save path
+    # A writer must only be released once its source ended, writing the path again reopens and truncates the file
+    def __init__(self):
+        self.writers = {}
 
-    def __len__(self):
-        return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
+    def write(self, path, im0, video=None):
+        # Append im0 to the video (fps, w, h) saved to path, or to the stream saved to path.mp4 at 30 FPS
+        if path not in self.writers:  # new video
+            fps, w, h = video or (30, im0.shape[1], im0.shape[0])
+            f = path if video else path + '.mp4'
+            self.writers[path] = cv2.VideoWriter(f, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        self.writers[path].write(im0)
+
+    def release(self, paths=None):
+        # Release the writers of paths that are open, all if None
+        for f in set(self.writers) if paths is None else set(self.writers).intersection(paths):
+            self.writers.pop(f).release()
 
 
 def img2label_paths(img_paths):
@@ -352,11 +636,300 @@ def img2label_paths(img_paths):
     return ['txt'.join(x.replace(sa, sb, 1).rsplit(x.split('.')[-1], 1)) for x in img_paths]
 
 
+def file_stat(f):
+    # Returns (size, mtime in ns) of a file, (-1, -1) if it does not exist
+    try:
+        s = os.stat(f)
+        return s.st_size, s.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def verify_image_label(args):
+    # Verify one image-label pair, returns (status, labels, shape, segments, message)
+    # status follows the cache counters: 0 found, 1 missing, 2 empty, 3 corrupted
+    im_file, lb_file, prefix = args
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if not os.path.isfile(lb_file):
+            return 1, np.zeros((0, 4+n_att), dtype=np.float32), shape, segments, ''  # label missing
+        with open(lb_file, 'r') as f:
+            l = [x.split() for x in f.read().strip().splitlines()]
+            if any([len(x) > 8 for x in l]):  # is segment
+                classes = np.array([x[:n_att] for x in l], dtype=np.float32)
+                segments = [np.array(x[n_att:], dtype=np.float32).reshape(-1, 2) for x in l]  # (att0..att3, xy1...)
+                l = np.concatenate((classes.reshape(-1, n_att), segments2boxes(segments)), 1)  # (att0..att3, xywh)
+            l = np.array(l, dtype=np.float32)
+        if not len(l):
+            return 2, np.zeros((0, 4+n_att), dtype=np.float32), shape, segments, ''  # label empty
+        assert l.shape[1] == (4+n_att), 'labels require 5 columns each'
+        assert (l >= 0).all(), 'negative labels'
+        assert (l[:, n_att:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+        return 0, l, shape, segments, ''
+    except Exception as e:
+        return 3, np.zeros((0, 4+n_att), dtype=np.float32), (0, 0), [], \
+            f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
+def ragged_take(offsets, rows):
+    # Gather rows of a ragged array stored as values + (n+1,) offsets, returns (value indices, new offsets)
+    counts = offsets[rows + 1] - offsets[rows]
+    new_offsets = ragged_offsets(counts)
+    return np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - offsets[rows], counts), new_offsets
+
+
+def ragged_offsets(counts):
+    # (n+1,) offsets of a ragged array from its (n,) row lengths
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def load_npz_member(path, info):
+    # Memory-map one uncompressed .npy member of an .npz archive in place (read-only, pages shared between processes)
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', f.read(30)[26:])  # zip local file header
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    if not np.prod(shape):  # empty arrays can not be mapped
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+def load_label_cache(path, mmap=True):
+    # Returns the label cache at path as a dict of arrays, None if missing, unreadable or of another version
+    # With mmap the ragged label, segment and offset arrays are memory-mapped from the file instead of read
+    try:
+        with np.load(path) as x:
+            if 'version' not in x.files or float(x['version']) != cache_version:
+                return None
+            cache = {k: x[k] for k in x.files if not (mmap and k in mmap_keys)}
+        if mmap:
+            with zipfile.ZipFile(path) as z:
+                for info in z.infolist():
+                    k = info.filename[:-4]  # strip .npy
+                    if k in mmap_keys:
+                        assert info.compress_type == zipfile.ZIP_STORED, f'{k} is compressed'
+                        cache[k] = load_npz_member(path, info)
+        cache['files'] = bytes(cache['files']).decode('utf-8').split('\n') if len(cache['files']) else []
+        return cache
+    except Exception:
+        return None
+
+
+class RaggedRows:
+    # Read-only per-image rows of one contiguous array, row i is values[starts[i]:ends[i]]
+    # Rows are views (no copy per image), nested RaggedRows values give lists of views (i.e. segments)
+    def __init__(self, values, starts, ends):
+        self.values = values
+        self.starts, self.ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+
+    @classmethod
+    def from_offsets(cls, values, offsets):
+        return cls(values, offsets[:-1], offsets[1:])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, (np.ndarray, list, slice)):  # reorder or subset, values are shared
+            return RaggedRows(self.values, self.starts[i], self.ends[i])
+        a, b = self.starts[i], self.ends[i]
+        if isinstance(self.values, RaggedRows):
+            return [self.values[j] for j in range(a, b)]
+        return self.values[a:b]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def save_label_cache(path, cache):
+    # Write the label cache dict of arrays atomically (no partially written cache is ever read)
+    x = dict(cache, files=np.frombuffer('\n'.join(cache['files']).encode('utf-8'), dtype=np.uint8),
+             version=np.array(cache_version))
+    tmp = path.with_suffix('.cache.tmp')
+    with open(tmp, 'wb') as f:
+        np.savez(f, **x)
+    os.replace(tmp, path)
+
+
+class PackedStore:
+    # Base of the packed stores, uint8 pixels in one file (self.path) plus an .npz index (self.index_path) whose key
+    # identifies the dataset, the pixel file is memory-mapped so DataLoader workers share its pages
+    def load_index(self, key):
+        # Returns the index dict if it matches key and the pixel file, else None
+        try:
+            with np.load(self.index_path) as x:
+                index = {k: x[k] for k in x.files}
+            assert str(index['key']) == key and self.path.stat().st_size == index['nbytes']
+            return index
+        except Exception:
+            return None
+
+    def save(self, tmp, index):
+        # Move the written pixel file tmp into place, then write the index (last, a crash in between leaves a stale key)
+        os.replace(tmp, self.path)
+        tmp = self.index_path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **index)
+        os.replace(tmp, self.index_path)
+
+    def open(self):
+        return np.memmap(self.path, dtype=np.uint8, mode='r') if self.path.stat().st_size else np.zeros(0, np.uint8)
+
+    def __getstate__(self):  # do not pickle the mapped file into (spawned) workers
+        state = self.__dict__.copy()
+        if isinstance(self.pixels, np.memmap):
+            state['pixels'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.pixels is None:
+            self.pixels = self.open()
+
+
+class SegmentCropBank(PackedStore):
+    # Masked crops of every labelled segment of a dataset for paste-in, extracted once at training resolution
+    # crops[i] returns (attributes, image, mask), recently used crops are kept in a per-process LRU of lru_bytes
+    def __init__(self, dataset, path, key, lru_bytes=2 ** 26, prefix=''):
+        self.path = Path(path)  # packed (h,w,3) image + (h,w) mask pixels of each crop
+        self.index_path = self.path.with_suffix('.crops.npz')  # key, labels, shapes and byte offsets
+        self.lru, self.lru_bytes, self.cached_bytes = OrderedDict(), lru_bytes, 0
+        index = self.load_index(key)
+        self.pixels = None
+        if index is None:
+            index, self.pixels = self.build(dataset, key, prefix)
+        self.labels, self.shapes, self.offsets = index['labels'], index['shapes'], index['offsets']
+        if self.pixels is None:
+            self.pixels = self.open()
+
+    def build(self, dataset, key, prefix=''):
+        # Extract crops with a thread pool and stream them to disk, kept in memory if the directory is not writeable
+        tmp = self.path.with_suffix('.crops.tmp')
+        try:
+            f = open(tmp, 'wb')
+        except OSError as e:
+            logging.warning(f'{prefix}WARNING: Cache directory {self.path.parent} is not writeable: {e}')
+            f = io.BytesIO()
+        images = np.nonzero(dataset.segments.ends > dataset.segments.starts)[0]  # images with segments
+        labels, shapes, offsets = [], [], [0]
+        with ThreadPool(num_threads) as pool:
+            pbar = tqdm(pool.imap(lambda i: load_segment_crops(dataset, i), images), total=len(images),
+                        desc=f'{prefix}Extracting paste-in crops')
+            for crops in pbar:
+                for l, img, mask in crops:
+                    f.write(img.tobytes())
+                    f.write(mask.tobytes())
+                    labels.append(l)
+                    shapes.append(mask.shape)
+                    offsets.append(offsets[-1] + img.nbytes + mask.nbytes)
+            pbar.close()
+        index = dict(key=np.array(key), nbytes=np.array(offsets[-1]),
+                     labels=np.array(labels, dtype=np.float32).reshape(-1, n_att),
+                     shapes=np.array(shapes, dtype=np.int64).reshape(-1, 2), offsets=np.array(offsets, dtype=np.int64))
+        if isinstance(f, io.BytesIO):
+            return index, np.frombuffer(f.getvalue(), dtype=np.uint8)
+        f.close()
+        self.save(tmp, index)
+        logging.info(f'{prefix}Paste-in crops saved: {self.path} ({len(labels)} crops from {len(images)} images)')
+        return index, None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, i):
+        x = self.lru.get(i)
+        if x is None:
+            (h, w), o = self.shapes[i], self.offsets[i]
+            img = np.array(self.pixels[o:o + h * w * 3]).reshape(h, w, 3)
+            mask = np.array(self.pixels[o + h * w * 3:o + h * w * 4]).reshape(h, w)
+            x = self.labels[i], img, mask
+            self.lru[i] = x
+            self.cached_bytes += h * w * 4
+            while self.cached_bytes > self.lru_bytes and len(self.lru) > 1:
+                _, (_, img, mask) = self.lru.popitem(last=False)
+                self.cached_bytes -= img.nbytes + mask.nbytes
+        else:
+            self.lru.move_to_end(i)
+        return x
+
+    def __getstate__(self):  # the LRU is per process
+        return dict(super().__getstate__(), lru=OrderedDict(), cached_bytes=0)
+
+
+class ImageStore(PackedStore):
+    # Resized uint8 images of a dataset packed into one file with an offset/shape index, built in parallel and
+    # reused across runs, store.load(i) returns a zero-copy view like load_image(), in_memory reads the file into one
+    # buffer instead of mapping it, low_res > 0 adds a variant resized to low_res (e.g. for multi-scale)
+    def __init__(self, files, path, key, img_size, low_res=0, augment=False, in_memory=False, prefix=''):
+        self.path = Path(path)  # packed (h,w,3) pixels of each image and variant
+        self.index_path = self.path.with_suffix('.images.npz')  # key, original hw, shapes and byte offsets
+        self.sizes = (img_size, low_res) if low_res else (img_size,)
+        key = f'{key} {self.sizes} {augment}'
+        index = self.load_index(key)
+        if index is None:
+            index = self.build(files, key, augment, prefix)
+        self.hw0, self.shapes, self.offsets = index['hw0'], index['shapes'], index['offsets']  # (n,2), (n,k,2), (n,k)
+        self.pixels = np.fromfile(self.path, dtype=np.uint8) if in_memory else self.open()
+
+    def build(self, files, key, augment, prefix=''):
+        def load(f):
+            img = cv2.imread(f)  # BGR
+            assert img is not None, 'Image Not Found ' + f
+            return img.shape[:2], [resize_image(img, s, augment) for s in self.sizes]
+
+        hw0, shapes, offsets, nbytes = [], [], [], 0
+        tmp = self.path.with_suffix('.images.tmp')
+        with open(tmp, 'wb') as f, ThreadPool(num_threads) as pool:
+            pbar = tqdm(pool.imap(load, files), total=len(files))
+            for h0w0, imgs in pbar:
+                hw0.append(h0w0)
+                for img in imgs:
+                    f.write(np.ascontiguousarray(img).tobytes())
+                    shapes.append(img.shape[:2])
+                    offsets.append(nbytes)
+                    nbytes += img.nbytes
+                pbar.desc = f'{prefix}Caching images ({nbytes / 1E9:.1f}GB)'
+            pbar.close()
+        k = len(self.sizes)
+        index = dict(key=np.array(key), nbytes=np.array(nbytes), hw0=np.array(hw0, dtype=np.int64).reshape(-1, 2),
+                     shapes=np.array(shapes, dtype=np.int64).reshape(-1, k, 2),
+                     offsets=np.array(offsets, dtype=np.int64).reshape(-1, k))
+        self.save(tmp, index)
+        return index
+
+    def __len__(self):
+        return len(self.hw0)
+
+    def load(self, i, low_res=False):
+        # Returns img, original hw, resized hw of image i
+        k = int(low_res and len(self.sizes) > 1)
+        (h, w), o = self.shapes[i, k], self.offsets[i, k]
+        return self.pixels[o:o + h * w * 3].reshape(h, w, 3), tuple(int(x) for x in self.hw0[i]), (int(h), int(w))
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', cache_low_res=0, batch_augment=False,
+                 fused_mosaic=False):
         self.img_size = img_size
         self.augment = augment
+        self.batch_augment = augment and batch_augment  # HSV, flips and mixup are left to augment_batch()
+        self.fused_mosaic = fused_mosaic  # render affine mosaics straight into the output, see mosaic_perspective()
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
@@ -390,31 +963,33 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
-        if cache_path.is_file():
-            cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
-        else:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+        cache, scanned = self.cache_labels(cache_path, prefix)  # only new or changed files are scanned
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
-        if exists:
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupted, total
+        if not scanned:
             d = f"Scanning '{cache_path}' images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {help_url}'
 
-        # Read cache
-        cache.pop('hash')  # remove hash
-        cache.pop('version')  # remove version
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
+        # Read cache, corrupted images are dropped
+        # Labels and segments stay in the memory-mapped cache, so DataLoader workers share them instead of
+        # copying per-image objects on write (refcounts)
+        keep = np.nonzero(cache['status'] != 3)[0]
+        self.labels = RaggedRows.from_offsets(cache['labels'], cache['label_offsets'])[keep]  # per image (n,4+n_att)
+        points = RaggedRows.from_offsets(cache['points'], cache['point_offsets'])  # per segment (n_points,2)
+        self.segments = RaggedRows.from_offsets(points, cache['segment_offsets'])[keep]  # per image segment lists
+        files = '\n'.join(cache['files'][i] for i in keep).encode()
+        image_key = hashlib.md5(np.ascontiguousarray(cache['stats'][keep][:, :2]).tobytes() + files).hexdigest()
+        crop_key = hashlib.md5(np.ascontiguousarray(cache['stats'][keep]).tobytes() + files +
+                               str(img_size).encode()).hexdigest()
+        shapes = cache['shapes'][keep]
         self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.img_files = [cache['files'][i] for i in keep]  # update
+        self.label_files = img2label_paths(self.img_files)  # update
         if single_cls:
-            for x in self.labels:
-                x[:, 0] = 0
+            self.labels.values = np.array(self.labels.values)  # private writable copy
+            self.labels.values[:, 0] = 0
 
         n = len(shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
@@ -422,6 +997,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         self.batch = bi  # batch index of image
         self.n = n
         self.indices = range(n)
+        self.image_rows = np.arange(n)  # row of each image in the image store
+        image_files = self.img_files
 
         # Rectangular Training
         if self.rect:
@@ -431,97 +1008,106 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             irect = ar.argsort()
             self.img_files = [self.img_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.labels = self.labels[irect]
+            self.image_rows = self.image_rows[irect]
+            self.segments = self.segments[irect]
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
             # Set training image shapes
-            shapes = [[1, 1]] * nb
-            for i in range(nb):
-                ari = ar[bi == i]
-                mini, maxi = ari.min(), ari.max()
-                if maxi < 1:
-                    shapes[i] = [maxi, 1]
-                elif mini > 1:
-                    shapes[i] = [1, 1 / mini]
-
-            self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
-
-        # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        self.imgs = [None] * n
-        if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
-                    gb += self.imgs[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
-            pbar.close()
+            self.batch_shapes = np.array([rect_shape(ar[bi == i], img_size, stride, pad) for i in range(nb)])
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
+        # Cache images, resized images are packed into one file next to the label cache and reused across runs
+        # 'disk' memory-maps it, 'ram' (or True) reads it into one buffer (WARNING: may exceed system RAM)
+        # low_res switches load_image() to the cache_low_res variant
+        self.image_store, self.low_res = None, False
+        if cache_images:
             try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == (4+n_att), 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, n_att:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
+                name = f"{img_size}{'' if augment else '-area'}.images"  # one store per size and interpolation
+                self.image_store = ImageStore(image_files, cache_path.with_suffix(f'.{name}'), image_key, img_size,
+                                              low_res=cache_low_res, augment=augment,
+                                              in_memory=cache_images != 'disk', prefix=prefix)
+            except OSError as e:
+                logging.warning(f'{prefix}WARNING: Images not cached, {cache_path.parent} is not writeable: {e}')
+
+        # Paste-in crops, extracted once per dataset instead of re-rendering mosaics in every __getitem__
+        self.crop_bank = None
+        if augment and hyp and hyp.get('paste_in', 0) > 0:
+            self.crop_bank = SegmentCropBank(self, cache_path.with_suffix('.crops'), crop_key, prefix=prefix)
 
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
+        # Incremental label cache keyed by per-file (size, mtime), returns (cache, number of scanned images)
+        # Unchanged images reuse their cached rows, new or changed image-label pairs are verified by a process pool
+        n = len(self.img_files)
+        with ThreadPool(num_threads) as pool:
+            stats = np.array(pool.map(file_stat, self.img_files + self.label_files, chunksize=1024),
+                             dtype=np.int64).reshape(2, n, 2).transpose(1, 0, 2).reshape(n, 4)  # im, lb (size, mtime)
+        old = load_label_cache(path)
+        if old is None:
+            old = dict(files=[], stats=np.zeros((0, 4), dtype=np.int64), shapes=np.zeros((0, 2), dtype=np.int64),
+                       status=np.zeros(0, dtype=np.int8), label_offsets=np.zeros(1, dtype=np.int64),
+                       labels=np.zeros((0, 4+n_att), dtype=np.float32), segment_offsets=np.zeros(1, dtype=np.int64),
+                       point_offsets=np.zeros(1, dtype=np.int64), points=np.zeros((0, 2), dtype=np.float32))
+        index = {f: i for i, f in enumerate(old['files'])}
+        rows = np.array([index.get(f, -1) for f in self.img_files], dtype=np.int64)  # row in the old cache
+        reuse = rows >= 0
+        reuse[reuse] = (old['stats'][rows[reuse]] == stats[reuse]).all(1)
+        scan = np.nonzero(~reuse)[0]
+
+        # Verify new or changed image-label pairs
+        results = []
+        if len(scan):
+            with Pool(num_threads) as pool:
+                pbar = tqdm(pool.imap(verify_image_label, ((self.img_files[i], self.label_files[i], prefix) for i in scan),
+                                      chunksize=64), desc='Scanning images', total=len(scan))
+                counts = np.zeros(4, dtype=np.int64)  # found, missing, empty, corrupted
+                for status, l, shape, segments, msg in pbar:
+                    results.append((status, l, shape, segments))
+                    counts[status] += 1
+                    if msg:
+                        print(msg)
+                    pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
+                                f"{counts[0] + counts[2]} found, {counts[1]} missing, {counts[2]} empty, {counts[3]} corrupted"
+                pbar.close()
+
+        unchanged = not len(scan) and len(old['files']) == n and (rows == np.arange(n)).all()
+        if unchanged:  # use the memory-mapped cache as is
+            x = old
+        else:
+            x = self.merge_labels(old, stats, reuse, rows, results)
+            old = None  # release the mapping before the file is replaced
 
+        nm, ne, nc = [int((x['status'] == s).sum()) for s in (1, 2, 3)]
+        nf = int((x['status'] == 0).sum()) + ne  # label files found, including empty ones
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
-
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
-        torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
+        if not unchanged:
+            try:
+                save_label_cache(path, x)  # save for next time
+                x = load_label_cache(path) or x  # memory-map the saved arrays
+                logging.info(f'{prefix}Label cache updated: {path} ({len(scan)} of {n} images scanned)')
+            except Exception as e:
+                logging.warning(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')
+        x['results'] = nf, nm, ne, nc, n
+        return x, len(scan)
+
+    def merge_labels(self, old, stats, reuse, rows, results):
+        # Merge cached and scanned rows, scanned ones are appended to the old arrays and gathered in image order
+        status, l, shape, segments = zip(*results) if results else ((), (), (), ())
+        src = np.where(reuse, rows, len(old['files']) + np.cumsum(~reuse) - 1)
+        segments_counts = [len(s) for s in segments]
+        points = [x for s in segments for x in s]
+        x = dict(files=self.img_files, stats=stats)
+        x['status'] = np.concatenate((old['status'], np.array(status, dtype=np.int8)))[src]
+        x['shapes'] = np.concatenate((old['shapes'], np.array(shape, dtype=np.int64).reshape(-1, 2)))[src]
+        offsets = np.concatenate((old['label_offsets'], old['label_offsets'][-1] + ragged_offsets([len(y) for y in l])[1:]))
+        i, x['label_offsets'] = ragged_take(offsets, src)
+        x['labels'] = np.concatenate((old['labels'], *l))[i]
+        offsets = np.concatenate((old['segment_offsets'], old['segment_offsets'][-1] + ragged_offsets(segments_counts)[1:]))
+        i, x['segment_offsets'] = ragged_take(offsets, src)
+        offsets = np.concatenate((old['point_offsets'], old['point_offsets'][-1] + ragged_offsets([len(y) for y in points])[1:]))
+        i, x['point_offsets'] = ragged_take(offsets, i)
+        x['points'] = np.concatenate((old['points'], *points))[i]
         return x
 
     def __len__(self):
@@ -547,7 +1133,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             shapes = None
 
             # MixUp https://arxiv.org/pdf/1710.09412.pdf
-            if random.random() < hyp['mixup']:
+            if not self.batch_augment and random.random() < hyp['mixup']:
                 if random.random() < 0.8:
                     img2, labels2 = load_mosaic(self, random.randint(0, len(self.labels) - 1))
                 else:
@@ -565,14 +1151,17 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
-            labels = self.labels[index].copy()
+            labels = self.labels[index]  # read-only view, converted into a new array
             if labels.size:  # normalized xywh to pixel xyxy format
-                labels[:, n_att:] = xywhn2xyxy(labels[:, n_att:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
+                labels = np.concatenate((labels[:, :n_att], xywhn2xyxy(labels[:, n_att:], ratio[0] * w, ratio[1] * h,
+                                                                       padw=pad[0], padh=pad[1])), 1)
+            else:
+                labels = labels.copy()
 
         if self.augment:
             # Augment imagespace
             if not mosaic:
-                print("111",labels)
+                diag.debug('random_perspective on a non-mosaic sample with %g labels', len(labels))
                 img, labels = random_perspective(img, labels,
                                                  degrees=hyp['degrees'],
                                                  translate=hyp['translate'],
@@ -584,23 +1173,15 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             #img, labels = self.albumentations(img, labels)
 
             # Augment colorspace
-            augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            if not self.batch_augment:
+                augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
             # Apply cutouts
             # if random.random() < 0.9:
             #     labels = cutout(img, labels)
             
             if random.random() < hyp['paste_in']:
-                sample_labels, sample_images, sample_masks = [], [], [] 
-                while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
-                    sample_labels += sample_labels_
-                    sample_images += sample_images_
-                    sample_masks += sample_masks_
-                    #print(len(sample_labels))
-                    if len(sample_labels) == 0:
-                        break
-                labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
+                labels = pastein(img, labels, self.crop_bank)
 
         nL = len(labels)  # number of labels
         if nL:
@@ -608,7 +1189,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [n_att+1,n_att+3]] /= img.shape[0]  # normalized height 0-1
             labels[:, [n_att, n_att+2]] /= img.shape[1]  # normalized width 0-1
 
-        if self.augment:
+        if self.augment and not self.batch_augment:
             # flip up-down
             if random.random() < hyp['flipud']:
                 img = np.flipud(img)
@@ -668,19 +1249,24 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 # Ancillary functions --------------------------------------------------------------------------------------------------
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
-    img = self.imgs[index]
-    if img is None:  # not cached
-        path = self.img_files[index]
-        img = cv2.imread(path)  # BGR
-        assert img is not None, 'Image Not Found ' + path
-        h0, w0 = img.shape[:2]  # orig hw
-        r = self.img_size / max(h0, w0)  # resize image to img_size
-        if r != 1:  # always resize down, only resize up if training with augmentation
-            interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
-            img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
-        return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
-    else:
-        return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
+    if self.image_store is not None:  # cached, read-only view
+        return self.image_store.load(self.image_rows[index], self.low_res)
+    path = self.img_files[index]
+    img = cv2.imread(path)  # BGR
+    assert img is not None, 'Image Not Found ' + path
+    h0, w0 = img.shape[:2]  # orig hw
+    img = resize_image(img, self.img_size, self.augment)
+    return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
+
+
+def resize_image(img, img_size, augment=False):
+    # resize image so that its long side is img_size
+    h0, w0 = img.shape[:2]  # orig hw
+    r = img_size / max(h0, w0)  # resize image to img_size
+    if r != 1:  # always resize down, only resize up if training with augmentation
+        interp = cv2.INTER_AREA if r < 1 and not augment else cv2.INTER_LINEAR
+        img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+    return img
 
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
@@ -697,6 +1283,65 @@ def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)  # no return needed
 
 
+def augment_hsv_batch(imgs, hgain=0.5, sgain=0.5, vgain=0.5):
+    # augment_hsv() of a uint8 RGB batch (bs,3,h,w) on its device, hue is handled in [0, 1) instead of OpenCV's [0, 180)
+    r = (torch.rand(len(imgs), 3, 1, 1, device=imgs.device) * 2 - 1) * torch.tensor(
+        [hgain, sgain, vgain], device=imgs.device).view(1, 3, 1, 1) + 1  # random gains
+    x = imgs.float()
+    red, green, blue = x.unbind(1)
+    val = torch.maximum(torch.maximum(red, green), blue)
+    delta = val - torch.minimum(torch.minimum(red, green), blue)
+    d = delta.clamp(min=1e-6)
+    hue = torch.where(val == red, (green - blue) / d, torch.where(val == green, (blue - red) / d + 2, (red - green) / d + 4))
+    hue = torch.where(hue < 0, hue + 6, hue)  # hue sector in [0, 6)
+
+    hue = hue.mul_(r[:, 0] / 6).frac_()  # (hue * gain) % 1
+    sat = (delta / val.clamp(min=1e-6)).mul_(r[:, 1]).clamp_(0, 1)
+    val = val.mul_(r[:, 2]).clamp_(0, 255)
+
+    # HSV to RGB, f(n) = v - v * s * clip(min(k, 4 - k), 0, 1) with k = (n + 6 * h) % 6 for n = 5, 3, 1
+    k = hue.mul_(6)[:, None] + torch.tensor([5., 3., 1.], device=imgs.device).view(1, 3, 1, 1)
+    k = torch.where(k >= 6, k - 6, k)
+    k = torch.minimum(k, 4 - k).clamp_(0, 1).mul_(sat[:, None])
+    return k.neg_().add_(1).mul_(val[:, None]).round_().to(torch.uint8)
+
+
+def augment_batch(imgs, targets, hyp, mixup=True):
+    # Batch-level mixup, HSV and flips of collated uint8 RGB imgs (bs,3,h,w) and targets (img, att0..att3, xywh), the
+    # vectorized counterpart of the per-sample augmentation that LoadImagesAndLabels(batch_augment=True) skips
+    # mixup blends mosaics with another image of the batch instead of a freshly loaded mosaic
+    bs, device = len(imgs), imgs.device
+
+    # MixUp https://arxiv.org/pdf/1710.09412.pdf
+    if mixup and hyp['mixup'] > 0 and bs > 1:
+        i = torch.nonzero(torch.rand(bs) < hyp['mixup'])[:, 0]
+        if len(i):
+            j = (i + torch.randint(1, bs, (len(i),))) % bs  # partner image, never itself
+            r = torch.distributions.Beta(8.0, 8.0).sample((len(i), 1, 1, 1)).to(device)  # mixup ratio, alpha=beta=8.0
+            imgs = imgs.clone()
+            imgs[i.to(device)] = (imgs[i.to(device)] * r + imgs[j.to(device)] * (1 - r)).to(torch.uint8)
+            pair, row = torch.nonzero(targets[:, 0].long()[None] == j[:, None], as_tuple=True)  # partner labels
+            labels2 = targets[row]
+            labels2[:, 0] = i[pair].to(targets)
+            targets = torch.cat((targets, labels2), 0)
+            targets = targets[targets[:, 0].argsort()]
+
+    # Augment colorspace
+    if hyp['hsv_h'] or hyp['hsv_s'] or hyp['hsv_v']:
+        imgs = augment_hsv_batch(imgs, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+
+    # Flip up-down and left-right
+    for p, dim, col in (hyp['flipud'], 2, n_att + 2), (hyp['fliplr'], 3, n_att + 1):
+        flip = torch.rand(bs) < p
+        if flip.any():
+            i = flip.to(device)
+            imgs = torch.where(i.view(-1, 1, 1, 1), imgs.flip(dim), imgs)
+            f = flip.to(targets.device)[targets[:, 0].long()]
+            targets[f, col] = 1 - targets[f, col]
+
+    return imgs, targets
+
+
 def hist_equalize(img, clahe=True, bgr=False):
     # Equalize histogram on BGR image 'img' with img.shape(n,m,3) and range 0-255
     yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV if bgr else cv2.COLOR_RGB2YUV)
@@ -711,7 +1356,7 @@ def hist_equalize(img, clahe=True, bgr=False):
 def load_mosaic(self, index):
     # loads images in a 4-mosaic
 
-    labels4, segments4 = [], []
+    labels4, segments4, tiles = [], [], []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -721,7 +1366,6 @@ def load_mosaic(self, index):
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -734,14 +1378,14 @@ def load_mosaic(self, index):
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+        tiles.append((img[y1b:y2b, x1b:x2b], x1a, y1a))  # img4[ymin:ymax, xmin:xmax]
         padw = x1a - x1b
         padh = y1a - y1b
 
         # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, n_att:] = xywhn2xyxy(labels[:, n_att:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
+        labels, segments = self.labels[index], self.segments[index]  # read-only views, converted into new arrays
+        if labels.size:  # normalized xywh to pixel xyxy format
+            labels = np.concatenate((labels[:, :n_att], xywhn2xyxy(labels[:, n_att:], w, h, padw, padh)), 1)
             segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
         labels4.append(labels)
         segments4.extend(segments)
@@ -754,16 +1398,7 @@ def load_mosaic(self, index):
 
     # Augment
     #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
-    #sample_segments(img4, labels4, segments4, probability=self.hyp['copy_paste'])
-    img4, labels4, segments4 = copy_paste(img4, labels4, segments4, probability=self.hyp['copy_paste'])
-    #print("222",labels4)
-    img4, labels4 = random_perspective(img4, labels4, segments4,
-                                       degrees=self.hyp['degrees'],
-                                       translate=self.hyp['translate'],
-                                       scale=self.hyp['scale'],
-                                       shear=self.hyp['shear'],
-                                       perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+    img4, labels4 = mosaic_perspective(self, tiles, labels4, segments4)
 
     return img4, labels4
 
@@ -771,7 +1406,7 @@ def load_mosaic(self, index):
 def load_mosaic9(self, index):
     # loads images in a 9-mosaic
 
-    labels9, segments9 = [], []
+    labels9, segments9, tiles = [], [], []
     s = self.img_size
     indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
     for i, index in enumerate(indices):
@@ -780,7 +1415,6 @@ def load_mosaic9(self, index):
 
         # place img in img9
         if i == 0:  # center
-            img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             h0, w0 = h, w
             c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
         elif i == 1:  # top
@@ -804,20 +1438,20 @@ def load_mosaic9(self, index):
         x1, y1, x2, y2 = [max(x, 0) for x in c]  # allocate coords
 
         # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, n_att:] = xywhn2xyxy(labels[:, n_att:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
+        labels, segments = self.labels[index], self.segments[index]  # read-only views, converted into new arrays
+        if labels.size:  # normalized xywh to pixel xyxy format
+            labels = np.concatenate((labels[:, :n_att], xywhn2xyxy(labels[:, n_att:], w, h, padx, pady)), 1)
             segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
         labels9.append(labels)
         segments9.extend(segments)
 
         # Image
-        img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+        tiles.append((img[y1 - pady:, x1 - padx:], x1, y1))  # img9[ymin:ymax, xmin:xmax]
         hp, wp = h, w  # height, width previous
 
     # Offset
     yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
-    img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
+    tiles = [(img, x - xc, y - yc) for img, x, y in tiles]  # img9[yc:yc + 2 * s, xc:xc + 2 * s]
 
     # Concat/clip labels
     labels9 = np.concatenate(labels9, 0)
@@ -832,68 +1466,94 @@ def load_mosaic9(self, index):
 
     # Augment
     #img9, labels9, segments9 = remove_background(img9, labels9, segments9)
-    img9, labels9, segments9 = copy_paste(img9, labels9, segments9, probability=self.hyp['copy_paste'])
-    #print("555",labels9)
-    img9, labels9 = random_perspective(img9, labels9, segments9,
-                                       degrees=self.hyp['degrees'],
-                                       translate=self.hyp['translate'],
-                                       scale=self.hyp['scale'],
-                                       shear=self.hyp['shear'],
-                                       perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+    img9, labels9 = mosaic_perspective(self, tiles, labels9, segments9)
 
     return img9, labels9
 
 
-def load_samples(self, index):
-    # loads images in a 4-mosaic
-
-    labels4, segments4 = [], []
-    s = self.img_size
-    yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
-    indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
-    for i, index in enumerate(indices):
-        # Load image
-        img, _, (h, w) = load_image(self, index)
-
-        # place img in img4
-        if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
-            x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
-            x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
-        elif i == 1:  # top right
-            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
-            x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
-        elif i == 2:  # bottom left
-            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
-            x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
-        elif i == 3:  # bottom right
-            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
-            x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
-
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
-        padw = x1a - x1b
-        padh = y1a - y1b
-
-        # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, n_att:] = xywhn2xyxy(labels[:, n_att:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
-        labels4.append(labels)
-        segments4.extend(segments)
-
-    # Concat/clip labels
-    labels4 = np.concatenate(labels4, 0)
-    for x in (labels4[:, n_att:], *segments4):
-        np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
-    # img4, labels4 = replicate(img4, labels4)  # replicate
+def mosaic_perspective(self, tiles, labels, segments):
+    # copy-paste and random_perspective() of the 2s x 2s mosaic of tiles [(img, x, y), ...]. With fused_mosaic an affine
+    # warp without copy-paste is rendered directly from the tiles, else the 114-filled canvas is warped. Fused images
+    # differ from the canvas ones along the tile seams, and perspective warps are slower fused, so it is opt-in
+    hyp, s = self.hyp, self.img_size
+    shape = (2 * s, 2 * s)
+    if not self.fused_mosaic or hyp['copy_paste'] or hyp['perspective']:
+        img = render_mosaic(tiles, shape)
+        img, labels, segments = copy_paste(img, labels, segments, probability=hyp['copy_paste'])
+        return random_perspective(img, labels, segments, degrees=hyp['degrees'], translate=hyp['translate'],
+                                  scale=hyp['scale'], shear=hyp['shear'], perspective=hyp['perspective'],
+                                  border=self.mosaic_border)  # border to remove
+
+    M, scale, width, height = random_perspective_matrix(shape, degrees=hyp['degrees'], translate=hyp['translate'],
+                                                        scale=hyp['scale'], shear=hyp['shear'],
+                                                        perspective=hyp['perspective'], border=self.mosaic_border)
+    img = warp_mosaic(tiles, shape, M, (width, height))
+    return img, warp_targets(labels, segments, M, scale, width, height)
+
+
+def render_mosaic(tiles, shape):
+    # returns the 114-filled canvas of shape hw with tiles [(img, x, y), ...] pasted at x, y (clipped to the canvas)
+    img4 = np.full((*shape, 3), 114, dtype=np.uint8)
+    for img, x, y in tiles:
+        h, w = img.shape[:2]
+        x1, y1, x2, y2 = max(x, 0), max(y, 0), min(x + w, shape[1]), min(y + h, shape[0])
+        if x2 > x1 and y2 > y1:
+            img4[y1:y2, x1:x2] = img[y1 - y:y2 - y, x1 - x:x2 - x]
+    return img4
+
+
+def warp_mosaic(tiles, shape, M, dsize, perspective=0.0):
+    # returns the warp by M of the canvas render_mosaic(tiles, shape) into dsize (w, h), rendered tile by tile
+    # every tile is cropped to the part that reaches the output, padded by 1 replicated pixel (bilinear samples across
+    # tile seams) and warped into its bounding box with a transparent border, so no 2s x 2s canvas is written
+    width, height = dsize
+    out = np.full((height, width, 3), 114, dtype=np.uint8)
+    corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]], dtype=np.float64)
+    xy = corners @ np.linalg.inv(M).T
+    xy = xy[:, :2] / xy[:, 2:3]  # output corners in canvas pixels
+    cx1, cy1 = np.floor(xy.min(0)).astype(int) - 2
+    cx2, cy2 = np.ceil(xy.max(0)).astype(int) + 2
+    for img, x, y in tiles:
+        h, w = img.shape[:2]
+        x1, y1 = max(x, 0, cx1), max(y, 0, cy1)  # visible canvas part of the tile
+        x2, y2 = min(x + w, shape[1], cx2), min(y + h, shape[0], cy2)
+        if x2 <= x1 or y2 <= y1:
+            continue
+        tile = cv2.copyMakeBorder(img[y1 - y:y2 - y, x1 - x:x2 - x], 1, 1, 1, 1, cv2.BORDER_REPLICATE)
+        T = np.eye(3)
+        T[:2, 2] = x1 - 1, y1 - 1  # padded tile to canvas
+        A = M @ T
+        th, tw = tile.shape[:2]
+        xy = np.array([[0, 0, 1], [tw, 0, 1], [0, th, 1], [tw, th, 1]], dtype=np.float64) @ A.T
+        xy = xy[:, :2] / xy[:, 2:3]  # tile corners in output pixels
+        ox1, oy1 = np.maximum(np.floor(xy.min(0)).astype(int), 0)
+        ox2, oy2 = np.minimum(np.ceil(xy.max(0)).astype(int) + 1, dsize)
+        if ox2 <= ox1 or oy2 <= oy1:
+            continue
+        T = np.eye(3)
+        T[:2, 2] = -ox1, -oy1  # output to bounding box
+        A = T @ A
+        roi = out[oy1:oy2, ox1:ox2]
+        if perspective:
+            cv2.warpPerspective(tile, A, (ox2 - ox1, oy2 - oy1), dst=roi, borderMode=cv2.BORDER_TRANSPARENT)
+        else:  # affine
+            cv2.warpAffine(tile, A[:2], (ox2 - ox1, oy2 - oy1), dst=roi, borderMode=cv2.BORDER_TRANSPARENT)
+    return out
 
-    # Augment
-    #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
-    sample_labels, sample_images, sample_masks = sample_segments(img4, labels4, segments4, probability=0.5)
 
-    return sample_labels, sample_images, sample_masks
+def load_segment_crops(self, index):
+    # loads the masked crops [(attributes, image, mask), ...] of all segments of 1 image at training resolution
+    img, _, (h, w) = load_image(self, index)
+    crops = []
+    for l, s in zip(self.labels[index], self.segments[index]):
+        x1, y1, x2, y2 = np.clip(xywhn2xyxy(l[None, n_att:], w, h)[0].astype(int), 0, [w - 1, h - 1, w - 1, h - 1])
+        if (x2 <= x1) or (y2 <= y1):
+            continue
+        mask = np.zeros((y2 - y1, x2 - x1), np.uint8)
+        cv2.drawContours(mask, [xyn2xy(s, w, h).astype(np.int32)], -1, 255, cv2.FILLED, offset=(-int(x1), -int(y1)))
+        crop = img[y1:y2, x1:x2]
+        crops.append((l[:n_att], cv2.bitwise_and(crop, crop, mask=mask), mask))
+    return crops
 
 
 def copy_paste(img, labels, segments, probability=0.5):
@@ -937,38 +1597,6 @@ def remove_background(img, labels, segments):
     return img_new, labels, segments
 
 
-def sample_segments(img, labels, segments, probability=0.5):
-    # Implement Copy-Paste augmentation https://arxiv.org/abs/2012.07177, labels as nx5 np.array(cls, xyxy)
-    n = len(segments)
-    sample_labels = []
-    sample_images = []
-    sample_masks = []
-    if probability and n:
-        h, w, c = img.shape  # height, width, channels
-        for j in random.sample(range(n), k=round(probability * n)):
-            l, s = labels[j], segments[j]
-            box = l[n_att].astype(int).clip(0,w-1), l[n_att+1].astype(int).clip(0,h-1), l[n_att+2].astype(int).clip(0,w-1), l[n_att+3].astype(int).clip(0,h-1) 
-            
-            #print(box)
-            if (box[2] <= box[0]) or (box[3] <= box[1]):
-                continue
-            
-            sample_labels.append(l[0])
-            
-            mask = np.zeros(img.shape, np.uint8)
-            
-            cv2.drawContours(mask, [segments[j].astype(np.int32)], -1, (255, 255, 255), cv2.FILLED)
-            sample_masks.append(mask[box[1]:box[3],box[0]:box[2],:])
-            
-            result = cv2.bitwise_and(src1=img, src2=mask)
-            i = result > 0  # pixels to replace
-            mask[i] = result[i]  # cv2.imwrite('debug.jpg', img)  # debug
-            #print(box)
-            sample_images.append(mask[box[1]:box[3],box[0]:box[2],:])
-
-    return sample_labels, sample_images, sample_masks
-
-
 def replicate(img, labels):
     # Replicate labels
     h, w = img.shape[:2]
@@ -1019,18 +1647,98 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     return img, ratio, (dw, dh)
 
 
+def letterbox_shape(shape, new_shape=640, stride=32, scaleup=True):
+    # (h, w) of letterbox(img, new_shape, auto=True) for an image of shape (h, w), the minimum stride-multiple rectangle
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    if not scaleup:
+        r = min(r, 1.0)
+    h, w = int(round(shape[0] * r)), int(round(shape[1] * r))
+    return h + (new_shape[0] - h) % stride, w + (new_shape[1] - w) % stride
+
+
+def letterbox_into(img, out, new_shape=None, color=(114, 114, 114), scaleup=True, bgr=True):
+    # letterbox(img, new_shape, auto=False) written into out, a preallocated (3, h, w) slice of a batch buffer. BGR to
+    # RGB (if bgr) and HWC to CHW happen in the copy out of the resized image. new_shape defaults to the shape of out,
+    # a smaller new_shape is padded up to it (letterbox_shape() gives the auto=True one). Returns ratio, (dw, dh)
+    h, w = out.shape[1:]
+    shape = img.shape[:2]  # current shape [height, width]
+    if new_shape is None:
+        new_shape = (h, w)
+    elif isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+
+    # Scale ratio (new / old)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    if not scaleup:  # only scale down, do not scale up (for better test mAP)
+        r = min(r, 1.0)
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = (w - new_unpad[0]) / 2, (h - new_unpad[1]) / 2  # padding of each side
+    if shape[::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+
+    # Border, then the image channels split straight into the CHW planes of out
+    top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+    y, x = slice(top, top + new_unpad[1]), slice(left, left + new_unpad[0])
+    c = np.array(color[::-1] if bgr else color, dtype=out.dtype)[:, None, None]
+    out[:, :y.start], out[:, y.stop:], out[:, y, :x.start], out[:, y, x.stop:] = c, c, c, c
+    planes = [out[i, y, x] for i in ((2, 1, 0) if bgr else (0, 1, 2))]
+    if any(a is not b for a, b in zip(cv2.split(img, planes), planes)):  # cv2 did not write in place (dtype)
+        out[:, y, x] = img.transpose(2, 0, 1)[::-1] if bgr else img.transpose(2, 0, 1)
+    return (r, r), (dw, dh)
+
+
+class BatchBuffers:
+    # Round robin of n reusable buffers that letterbox_into() fills, pinned when CUDA is available for fast (and
+    # non_blocking) host to device copies. A buffer is handed out again n get() calls later, so n must exceed the
+    # number of arrays in flight. Buffers grow to the largest request and are viewed at the requested shape and dtype
+    def __init__(self, n=2, pin=None):
+        self.n, self.i = n, 0
+        self.pin = torch.cuda.is_available() if pin is None else pin
+        self.buffers = [None] * n
+        self.lock = Lock()  # get() is called from loader threads
+
+    def get(self, shape, dtype=np.uint8):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize  # bytes
+        with self.lock:
+            i, self.i = self.i, (self.i + 1) % self.n
+            b = self.buffers[i]
+            if b is None or b.numel() < size:
+                b = self.buffers[i] = torch.empty(size, dtype=torch.uint8, pin_memory=self.pin)
+        return b[:size].numpy().view(dtype).reshape(shape)
+
+
 def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
     # targets = [cls, xyxy]
 
-    height = img.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = img.shape[1] + border[1] * 2
+    M, s, width, height = random_perspective_matrix(img.shape[:2], degrees, translate, scale, shear, perspective, border)
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
+    # ax[0].imshow(img[:, :, ::-1])  # base
+    # ax[1].imshow(img2[:, :, ::-1])  # warped
+
+    return img, warp_targets(targets, segments, M, s, width, height, perspective)
+
+
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # samples the random_perspective() transform of an image of shape hw, returns M, scale, output width and height
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -img.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -1057,19 +1765,11 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
-        if perspective:
-            img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
-        else:  # affine
-            img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+    return M, s, width, height
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(img[:, :, ::-1])  # base
-    # ax[1].imshow(img2[:, :, ::-1])  # warped
 
-    # Transform label coordinates
+def warp_targets(targets, segments, M, s, width, height, perspective=0.0):
+    # Transform label coordinates by M into a width x height image, drops degenerate boxes
     n = len(targets)
     #print("here",targets)
     if n:
@@ -1107,7 +1807,7 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
         targets = targets[i]
         targets[:, n_att:] = new[i]
 
-    return img, targets
+    return targets
 
 
 def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  # box1(4,n), box2(4,n)
@@ -1165,7 +1865,7 @@ def cutout(image, labels):
     return labels
     
 
-def pastein(image, labels, sample_labels, sample_images, sample_masks):
+def pastein(image, labels, crops):
     # Applies image cutout augmentation https://arxiv.org/abs/1708.04552
     h, w = image.shape[:2]
 
@@ -1189,34 +1889,25 @@ def pastein(image, labels, sample_labels, sample_images, sample_masks):
         else:
             ioa = np.zeros(1)
         
-        if (ioa < 0.30).all() and len(sample_labels) and (xmax > xmin+20) and (ymax > ymin+20):  # allow 30% obscuration of existing labels
-            sel_ind = random.randint(0, len(sample_labels)-1)
-            #print(len(sample_labels))
-            #print(sel_ind)
-            #print((xmax-xmin, ymax-ymin))
-            #print(image[ymin:ymax, xmin:xmax].shape)
-            #print([[sample_labels[sel_ind], *box]])
-            #print(labels.shape)
-            hs, ws, cs = sample_images[sel_ind].shape
+        if (ioa < 0.30).all() and len(crops) and (xmax > xmin+20) and (ymax > ymin+20):  # allow 30% obscuration of existing labels
+            sample_label, sample_image, sample_mask = crops[random.randint(0, len(crops)-1)]
+            hs, ws, cs = sample_image.shape
             r_scale = min((ymax-ymin)/hs, (xmax-xmin)/ws)
             r_w = int(ws*r_scale)
             r_h = int(hs*r_scale)
             
             if (r_w > 10) and (r_h > 10):
-                r_mask = cv2.resize(sample_masks[sel_ind], (r_w, r_h))
-                r_image = cv2.resize(sample_images[sel_ind], (r_w, r_h))
+                r_mask = cv2.resize(sample_mask, (r_w, r_h))
+                r_image = cv2.resize(sample_image, (r_w, r_h))
                 temp_crop = image[ymin:ymin+r_h, xmin:xmin+r_w]
                 m_ind = r_mask > 0
-                if m_ind.astype(np.int32).sum() > 60:
+                if m_ind.sum() * 3 > 60:  # 60 values of a 3-channel mask
                     temp_crop[m_ind] = r_image[m_ind]
-                    #print(sample_labels[sel_ind])
-                    #print(sample_images[sel_ind].shape)
-                    #print(temp_crop.shape)
                     box = np.array([xmin, ymin, xmin+r_w, ymin+r_h], dtype=np.float32)
                     if len(labels):
-                        labels = np.concatenate((labels, [[sample_labels[sel_ind], *box]]), 0)
+                        labels = np.concatenate((labels, [[*sample_label, *box]]), 0)
                     else:
-                        labels = np.array([[sample_labels[sel_ind], *box]])
+                        labels = np.array([[*sample_label, *box]])
                               
                     image[ymin:ymin+r_h, xmin:xmin+r_w] = temp_crop
 
@@ -1,10 +1,13 @@
 # YOLOR general utils
 
+import argparse
 import glob
 import logging
 import math
+import multiprocessing
 import os
 import platform
+import queue
 import random
 import re
 import subprocess
@@ -24,6 +27,13 @@ from utils.torch_utils import init_torch_seeds
 
 from PIL import Image, ImageDraw, ImageFont
 
+try:
+    import fcntl
+except ImportError:  # Windows, appends are not locked
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
 n_classes_lis=[9,5,2,4]
 n_att=4
 
@@ -36,10 +46,65 @@ cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with Py
 os.environ['NUMEXPR_MAX_THREADS'] = str(min(os.cpu_count(), 8))  # NumExpr max threads
 
 
-def set_logging(rank=-1):
+def set_logging(rank=-1, diagnostics=False):
     logging.basicConfig(
         format="%(message)s",
         level=logging.INFO if rank in [-1, 0] else logging.WARN)
+    if diagnostics:
+        Diagnostics.enable()
+
+
+class Diagnostics:
+    # Per-module diagnostics channel on top of logging: rate-limited debug messages and run counters.
+    # Disabled by default, then every call is a single attribute check, so channels are safe to use in hot paths.
+    # Enable with set_logging(diagnostics=True), read the counters with Diagnostics.collect() at the end of a run.
+    enabled = False
+    counters = {}  # 'module.key' -> count, shared by all channels
+    names = set()  # logger names of all channels
+
+    def __init__(self, name, interval=5.0):
+        self.logger = logging.getLogger(name)
+        self.interval = interval  # minimum seconds between two messages with the same format string
+        self.last = {}  # format string -> (time of last message, number suppressed since)
+        Diagnostics.names.add(name)
+        if Diagnostics.enabled:
+            self.logger.setLevel(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        # Log msg % args at DEBUG level, at most once per interval for the same msg. Keep args cheap to build
+        # (no tensor reductions), or guard the call with `if Diagnostics.enabled:`
+        if not Diagnostics.enabled or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        t = time.time()
+        last, suppressed = self.last.get(msg, (-math.inf, 0))
+        if t - last < self.interval:
+            self.last[msg] = (last, suppressed + 1)
+            return
+        self.last[msg] = (t, 0)
+        self.logger.debug(msg + (f' ({suppressed} similar suppressed)' if suppressed else ''), *args)
+
+    def count(self, key, n=1):
+        # Add n to the run counter of key
+        if Diagnostics.enabled:
+            key = f'{self.logger.name}.{key}'
+            Diagnostics.counters[key] = Diagnostics.counters.get(key, 0) + n
+
+    @staticmethod
+    def enable():
+        Diagnostics.enabled = True
+        for name in Diagnostics.names:
+            logging.getLogger(name).setLevel(logging.DEBUG)
+
+    @staticmethod
+    def collect(reset=False):
+        # Return a copy of the run counters, optionally clearing them
+        counters = dict(Diagnostics.counters)
+        if reset:
+            Diagnostics.counters.clear()
+        return counters
+
+
+diag = Diagnostics(__name__)
 
 
 def init_seeds(seed=0):
@@ -706,127 +771,141 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
 
 def non_max_suppression_MA(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=()):
-    """Runs Non-Maximum Suppression (NMS) on inference results
+    """Runs Non-Maximum Suppression (NMS) on multi-attribute inference results, batched over all images
 
     Returns:
-         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         list of detections, on (n,5+n_att) tensor per image [xyxy, conf, cls, att1, att2, ...]
     """
-    for k in range(1,n_att):
-        att_item = prediction[k][...,-(n_classes_lis[k]):]
-        prediction[0]=torch.cat([prediction[0],att_item],-1)
-
-    prediction=prediction[0]
-    #print("\nNMS_MA prediction",prediction.size())
-
-    i_att_lis=[5] #[5,85,88]
+    i_att_lis=[5] #[5,14,19,21,25]
     for k in range(n_att):
         i_att_lis.append(i_att_lis[k]+n_classes_lis[k])
 
+    bs = prediction[0].shape[0]  # batch size
     nc = n_classes_lis[0]  # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
 
     # Settings
-    min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
+    max_wh = 4096  # (pixels) maximum box width and height
     max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 10.0  # seconds to quit after
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.batched_nms()
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
-    t = time.time()
-    output = [torch.zeros((0, 5+n_att), device=prediction.device)] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        len_total=len(x)
-        x = x[xc[xi]]  # confidence
-        if len(x)>0:
-            print("\n",conf_thres,xi,"NMS_1,x = x[xc[xi]] [{}/{}]".format(len(x),len_total),max(x[:, 4]),min(x[:, 4]))
-        else:
-            print("\n",conf_thres,xi,"NMS_1,x = x[xc[xi]] [{}/{}]".format(len(x),len_total))
-            
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            l = labels[xi]
-            v = torch.zeros((len(l), sum(n_classes_lis) + 5), device=x.device)
-            v[:, :4] = l[:, n_att:4+n_att]  # box
-            v[:, 4] = 1.0  # conf
-            for k in range(n_att):
-                v[range(len(l)), l[:, k].long() + i_att_lis[k]] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        if nc == 1:
-            x[:, 5:] = x[:, 4:5] # for models with one class, cls_loss is 0 and cls_conf is always 0.5,
-                                 # so there is no need to multiplicate.
-        else:
-            x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        x0=x.clone()
-        if multi_label: 
-            i, j = (x0[:, 5:i_att_lis[1]] > conf_thres).nonzero(as_tuple=False).T
-            #print("\nNMS_3_multi,i, j = (x0[:, 5:i_att_lis[1]] > conf_thres).nonzero(as_tuple=False).T",max(x0[i, j + 5, None]),min(x0[i, j + 5, None]))
-            x= torch.cat((box[i], x0[i, j + 5, None], j[:, None].float()), -1)
-            #print("\ncls in nms",j)
-            for k in range(1,n_att):
-                att_item = x0[i,-(n_classes_lis[k]):]
-                _,indexes_att=att_item.max(1, keepdim=True)
-                x=torch.cat([x,indexes_att],-1)
-        else:  # best class only
-            conf, j = x0[:, 5:i_att_lis[1]].max(1, keepdim=True)
-            #print("\nNMS_3_best,conf, j = x0[:, 5:i_att_lis[1]].max(1, keepdim=True)",max(conf),min(conf))
-            x = torch.cat((box, conf, j.float()), -1)
-            for k in range(1,n_att):
-                att_item = x0[:,-(n_classes_lis[k]):]
-                _,indexes_att=att_item.max(1, keepdim=True)
-                x=torch.cat([x,indexes_att],-1)
-            x=x[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:5+n_att] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        #print("over NMS_MA",output[xi].size())
-        if (time.time() - t) > time_limit:
-            print(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
+    output = [torch.zeros((0, 5+n_att), device=prediction[0].device)] * bs
+
+    # Candidates of the whole batch, xi holds the image index and ai the anchor index of every row
+    xi, ai = (prediction[0][..., 4] > conf_thres).nonzero(as_tuple=True)
+    # Attribute scores are only gathered at the surviving anchors, the result is a copy safe to modify in place
+    x = torch.cat([prediction[0][xi, ai]] + [_gather_attributes(prediction[k], xi, ai, n_classes_lis[k])
+                                             for k in range(1, n_att)], 1)
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(l) for l in labels):
+        l = torch.cat(labels, 0)
+        v = torch.zeros((len(l), x.shape[1]), device=x.device, dtype=x.dtype)
+        v[:, :4] = l[:, n_att:4+n_att]  # box
+        v[:, 4] = 1.0  # conf
+        for k in range(n_att):
+            v[range(len(l)), l[:, k].long() + i_att_lis[k]] = 1.0  # cls
+        li = torch.arange(len(labels), device=x.device).repeat_interleave(
+            torch.tensor([len(l) for l in labels], device=x.device))
+        x, xi = torch.cat((x, v), 0), torch.cat((xi, li), 0)
+
+    diag.count('images', bs)
+    diag.count('candidates', x.shape[0])
+
+    # If none remain there is nothing to suppress
+    if not x.shape[0]:
+        return output
+
+    # Compute conf
+    if nc == 1:
+        x[:, 5:] = x[:, 4:5] # for models with one class, cls_loss is 0 and cls_conf is always 0.5,
+                             # so there is no need to multiplicate.
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Best index of every extra attribute at once, from a (n, n_att-1, max_classes) view padded with -inf
+    att_cols, att_valid = _attribute_columns(i_att_lis, x.device)
+    att = x[:, att_cols].masked_fill(~att_valid, -float('inf')).argmax(2).to(x.dtype)
+
+    # Detections matrix nx(5+n_att) (xyxy, conf, cls, att1, att2, ...)
+    if multi_label:
+        i, j = (x[:, 5:i_att_lis[1]] > conf_thres).nonzero(as_tuple=False).T
+        x = torch.cat((box[i], x[i, j + 5, None], j[:, None].to(x.dtype), att[i]), 1)
+        xi = xi[i]
+    else:  # best class only
+        conf, j = x[:, 5:i_att_lis[1]].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.to(x.dtype), att), 1)[keep]
+        xi = xi[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:5+n_att] == torch.tensor(classes, device=x.device)).any(1)
+        x, xi = x[keep], xi[keep]
+
+    # Check shape
+    n = x.shape[0]  # number of boxes
+    if not n:  # no boxes
+        return output
+    elif n > max_nms:  # excess boxes, keep the max_nms most confident of every image
+        i = x[:, 4].argsort(descending=True)
+        i = i[xi[i].sort(stable=True)[1]]  # image-major, confidence descending
+        i = i[_rank_in_group(xi[i], bs) < max_nms]
+        x, xi = x[i], xi[i]
+
+    # Batched NMS, boxes only suppress boxes of the same image (and class unless agnostic)
+    idxs = xi if agnostic else xi * nc + x[:, 5].long()
+    i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], idxs, iou_thres)  # sorted by decreasing score
+    i = i[xi[i].sort(stable=True)[1]]  # image-major, score descending within every image
+    i = i[_rank_in_group(xi[i], bs) < max_det]  # limit detections
+    if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
+        # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
+        iou = (box_iou(x[i, :4], x[:, :4]) > iou_thres) & (idxs[i, None] == idxs[None])  # iou matrix
+        weights = iou * x[None, :, 4]  # box weights
+        x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+        if redundant:
+            i = i[iou.sum(1) > 1]  # require redundancy
+
+    diag.count('detections', i.shape[0])
+    return list(x[i].split(torch.bincount(xi[i], minlength=bs).tolist()))
+
+
+def _gather_attributes(p, xi, ai, nc):
+    # Scores (n,nc) of one attribute head at anchors ai of images xi. p is either the (bs,anchors,no) inference output
+    # or, for lazy heads, the list of raw (bs,na*no,ny,nx) conv outputs, activated here for the gathered anchors only
+    if isinstance(p, torch.Tensor):
+        return p[xi, ai, -nc:]
+    out = torch.empty((len(ai), nc), device=ai.device, dtype=p[0].dtype)
+    start = 0  # first anchor index of the layer
+    for r in p:
+        bs, c, ny, nx = r.shape
+        na = c // nc  # number of anchors
+        j = ((ai >= start) & (ai < start + na * ny * nx)).nonzero(as_tuple=True)[0]
+        a, g = (ai[j] - start).div(ny * nx, rounding_mode='floor'), (ai[j] - start) % (ny * nx)  # anchor, grid cell
+        out[j] = r.view(bs, na, nc, ny * nx)[xi[j], a, :, g]
+        start += na * ny * nx
+    return out.sigmoid()
+
+
+def _rank_in_group(g, n):
+    # Position of every element inside its run of equal values, g is a sorted (n,) long tensor of group ids < n
+    counts = torch.bincount(g, minlength=n)
+    return torch.arange(len(g), device=g.device) - (counts.cumsum(0) - counts)[g]
+
+
+def _attribute_columns(i_att_lis, device):
+    # Column indices (n_att-1, max_classes) of the extra attributes and the mask of the real (non-padding) ones
+    widths = torch.tensor(n_classes_lis[1:n_att], device=device)
+    offsets = torch.arange(int(widths.max()), device=device)
+    valid = offsets < widths[:, None]
+    cols = torch.tensor(i_att_lis[1:n_att], device=device)[:, None] + offsets
+    return torch.where(valid, cols, torch.zeros_like(cols)), valid
 
-    return output
 
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, n_classes=None, nkpt=None):
@@ -936,7 +1015,9 @@ def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_op
     x['model'].half()  # to FP16
     for p in x['model'].parameters():
         p.requires_grad = False
-    torch.save(x, s or f)
+    tmp = Path(s or f).with_suffix('.tmp')
+    torch.save(x, tmp)
+    os.replace(tmp, s or f)  # new file, checkpoints hard-linked to f keep their optimizer
     mb = os.path.getsize(s or f) / 1E6  # filesize
     print(f"Optimizer stripped from {f},{(' saved as %s,' % s) if s else ''} {mb:.1f}MB")
 
@@ -972,6 +1053,162 @@ def print_mutation(hyp, results, yaml_file='hyp_evolved.yaml', bucket=''):
         os.system('gsutil cp evolve.txt %s gs://%s' % (yaml_file, bucket))  # upload
 
 
+class EvolveStore:
+    # Append-only evolve.txt shared by concurrent --evolve candidates (and other evolve runs on the same file). Appends
+    # hold an exclusive lock and reads only parse the rows appended since the last read. Row columns are results
+    # (P, R, mAP@0.5, mAP@0.5:0.95, val_losses x 3), hyps, epochs trained and fitness at the early-stop epoch
+    def __init__(self, path='evolve.txt', bucket=''):
+        self.path, self.bucket = Path(path), bucket
+        self.rows, self.offset = [], 0  # parsed rows, bytes parsed
+
+    @staticmethod
+    def lock(f, shared=False):
+        if fcntl:  # released on close
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def read(self):
+        # Returns all rows as an (n, columns) array, rows from older evolve.txt files NaN-padded
+        if self.path.exists():
+            with open(self.path, 'rb') as f:
+                self.lock(f, shared=True)
+                f.seek(self.offset)
+                s = f.read()
+            s = s[:s.rfind(b'\n') + 1]  # complete lines only
+            self.offset += len(s)
+            self.rows += [np.array(x.split(), dtype=np.float64) for x in s.decode().splitlines() if x.strip()]
+        x = np.full((len(self.rows), max((len(r) for r in self.rows), default=7)), np.nan)
+        for i, r in enumerate(self.rows):
+            x[i, :len(r)] = r
+        return x
+
+    def append(self, results, hyp, epochs, early_fitness=float('nan')):
+        # Append one candidate, results (P, R, mAP@0.5, mAP@0.5:0.95, val_losses x 3)
+        s = '%10.4g' * 7 % tuple(results) + '%10.3g' * len(hyp) % tuple(hyp.values()) + \
+            '%10.4g' * 2 % (epochs, early_fitness) + '\n'
+        with open(self.path, 'ab') as f:
+            self.lock(f)
+            f.write(s.encode())
+        if self.bucket:
+            os.system('gsutil cp %s gs://%s' % (self.path, self.bucket))  # upload
+
+    def save_best(self, hyp, yaml_file='hyp_evolved.yaml'):
+        # Save the best hyps to yaml_file and print them
+        x = self.read()
+        x = x[fitness(x).argmax()]
+        hyp = {k: float(x[i + 7]) for i, k in enumerate(hyp.keys())}
+        c = '%10.4g' * 7 % tuple(x[:7])  # results (P, R, mAP@0.5, mAP@0.5:0.95, val_losses x 3)
+        print('\n%s\n%s\nBest fitness: %s\n' % ('%10s' * len(hyp) % tuple(hyp.keys()),
+                                                 '%10.3g' * len(hyp) % tuple(hyp.values()), c))
+        with open(yaml_file, 'w') as f:
+            f.write('# Hyperparameter Evolution Results\n# Generations: %g\n# Metrics: ' % len(self.rows) + c + '\n\n')
+            yaml.dump(hyp, f, sort_keys=False)
+        if self.bucket:
+            os.system('gsutil cp %s gs://%s' % (yaml_file, self.bucket))  # upload
+
+
+class EvolveStopper:
+    # Stops an --evolve candidate whose fitness after `epoch` epochs is below the `quantile` of the fitness recorded
+    # by earlier candidates at the same epoch, once at least `n` of them have been recorded
+    def __init__(self, store, epoch, quantile=0.5, n=3):
+        self.store, self.epoch, self.quantile, self.n = store, epoch, quantile, n
+        self.fitness, self.stopped = float('nan'), False
+
+    def __call__(self, fi):
+        self.fitness = float(fi)
+        x = self.store.read()[:, -1]  # fitness at the early-stop epoch
+        x = x[~np.isnan(x)]
+        self.stopped = len(x) >= self.n and self.fitness < np.quantile(x, self.quantile)
+        return self.stopped
+
+
+def evolve_hyps(hyp, meta, opt, store, candidate, yaml_file='hyp_evolved.yaml', timeout=10):
+    # Evolve hyp within meta limits for opt.evolve candidates, opt.evolve_workers at a time. Each candidate is trained
+    # by candidate(i, hyp, opt, device, threads, stopper, results_queue) in its own spawned process, which puts
+    # (i, hyp, results, epochs trained, early fitness, error). Results are appended to store, best hyps to yaml_file
+
+    # Workers, one device (or an equal share of CPU threads) per candidate process
+    if opt.device.lower() == 'cpu' or not torch.cuda.is_available():
+        devices = ['cpu']
+    else:
+        devices = (opt.device or os.environ.get('CUDA_VISIBLE_DEVICES') or
+                   ','.join(str(i) for i in range(torch.cuda.device_count()))).split(',')
+    nw = max(opt.evolve_workers, 1)
+    threads = max(os.cpu_count() // nw, 1) if devices == ['cpu'] else 0
+    ctx = multiprocessing.get_context('spawn')  # fresh CUDA state per candidate
+    results_queue = ctx.Queue()
+    running, free = {}, list(range(nw))  # candidate: (process, worker), idle workers
+
+    n = 0  # candidates started
+    while n < opt.evolve or running:
+        while free and n < opt.evolve:
+            x = store.read()
+            if len(x):  # select best hyps and mutate
+                # Select parent(s)
+                parent = 'single'  # parent selection method: 'single' or 'weighted'
+                k = min(5, len(x))  # number of previous results to consider
+                x = x[np.argsort(-fitness(x))][:k]  # top k mutations
+                w = fitness(x) - fitness(x).min() + 1E-6  # weights (sum > 0)
+                if parent == 'single' or len(x) == 1:
+                    # x = x[random.randint(0, k - 1)]  # random selection
+                    x = x[random.choices(range(k), weights=w)[0]]  # weighted selection
+                elif parent == 'weighted':
+                    x = (x * w.reshape(k, 1)).sum(0) / w.sum()  # weighted combination
+                x = x[7:7 + len(hyp)]
+            elif n:  # first candidates, mutate the initial hyps
+                x = np.array(list(hyp.values()), dtype=np.float64)
+            else:  # train the initial hyps as is
+                x = None
+
+            # Mutate
+            mutation = hyp.copy()
+            if x is not None:
+                mp, s = 0.8, 0.2  # mutation probability, sigma
+                npr = np.random.RandomState()  # seeded per candidate, concurrent candidates differ
+                g = np.array([meta[k][0] if k in meta else 0 for k in hyp])  # gains 0-1
+                ng = len(hyp)
+                v = np.ones(ng)
+                while all(v == 1):  # mutate until a change occurs (prevent duplicates)
+                    v = (g * (npr.random(ng) < mp) * npr.randn(ng) * npr.random() * s + 1).clip(0.3, 3.0)
+                for i, k in enumerate(hyp.keys()):  # plt.hist(v.ravel(), 300)
+                    mutation[k] = float(x[i] * v[i])  # mutate
+
+            # Constrain to limits
+            for k, v in meta.items():
+                mutation[k] = max(mutation[k], v[1])  # lower limit
+                mutation[k] = min(mutation[k], v[2])  # upper limit
+                mutation[k] = round(mutation[k], 5)  # significant digits
+
+            # Train mutation
+            j = free.pop(0)
+            o = argparse.Namespace(**vars(opt))
+            o.save_dir = str(Path(opt.save_dir) / f'worker{j}')  # one run directory per worker
+            stopper = EvolveStopper(store, opt.evolve_stop) if opt.evolve_stop else None
+            p = ctx.Process(target=candidate,
+                            args=(n, mutation, o, devices[j % len(devices)], threads, stopper, results_queue))
+            p.start()
+            running[n] = p, j
+            n += 1
+
+        # Write mutation results
+        try:
+            i, mutation, results, epochs, early_fitness, e = results_queue.get(timeout=timeout)
+        except queue.Empty:
+            for i, (p, j) in list(running.items()):
+                if not p.is_alive() and p.exitcode:  # killed before reporting
+                    logger.warning(f'WARNING: --evolve candidate {i} exited with code {p.exitcode}')
+                    free.append(running.pop(i)[1])
+            continue
+        if i in running:
+            p, j = running.pop(i)
+            p.join()
+            free.append(j)
+        if e:
+            logger.warning(f'WARNING: --evolve candidate {i} failed: {e}')
+            continue
+        store.append(results, mutation, epochs, early_fitness)
+        store.save_best(hyp, yaml_file)
+
+
 def apply_classifier(x, model, img, im0):
     # applies a second stage classifier to yolo outputs
     im0 = [im0] if isinstance(im0, np.ndarray) else im0
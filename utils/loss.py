@@ -420,6 +420,73 @@ class APLoss(torch.autograd.Function):
         return g1*out_grad1, None, None
 
 
+def simota_assign(cand_b, pxyxys, p_obj, p_cls, t_b, txyxy, t_cls, bs):
+    # SimOTA dynamic-k assignment for a whole batch, returns (candidate indices, target indices) of the positives.
+    # Candidates and targets are scattered into per-image padded (bs, G, A) tensors so that the pairwise IoU/cost,
+    # the dynamic-k selection and the conflict resolution run as single tensor ops, without per-image or per-target
+    # Python loops and .item() host syncs. Positives come out image-major, in candidate order.
+    device = pxyxys.device
+    if not cand_b.shape[0] or not t_b.shape[0]:
+        empty = torch.zeros(0, dtype=torch.long, device=device)
+        return empty, empty
+
+    # Per-image slots, stable sorts keep the candidate and target order within each image
+    cand_b, cand_i = cand_b.sort(stable=True)
+    t_b, t_i = t_b.sort(stable=True)
+    na_img = torch.bincount(cand_b, minlength=bs)  # candidates per image
+    nt_img = torch.bincount(t_b, minlength=bs)  # targets per image
+    A, G = torch.stack((na_img.max(), nt_img.max())).tolist()
+    cand_slot = torch.arange(cand_b.shape[0], device=device) - (na_img.cumsum(0) - na_img)[cand_b]
+    t_slot = torch.arange(t_b.shape[0], device=device) - (nt_img.cumsum(0) - nt_img)[t_b]
+    cand_idx = torch.full((bs, A), -1, dtype=torch.long, device=device)
+    cand_idx[cand_b, cand_slot] = cand_i
+    t_idx = torch.full((bs, G), -1, dtype=torch.long, device=device)
+    t_idx[t_b, t_slot] = t_i
+    valid = (t_idx >= 0)[:, :, None] & (cand_idx >= 0)[:, None, :]  # (bs, G, A)
+    cand_idx_, t_idx_ = cand_idx.clamp(0), t_idx.clamp(0)  # padding gathers entry 0 and is masked out below
+
+    # Pairwise IoU
+    pbox, tbox = pxyxys[cand_idx_], txyxy[t_idx_]  # (bs, A, 4), (bs, G, 4)
+    area_p = (pbox[..., 2] - pbox[..., 0]) * (pbox[..., 3] - pbox[..., 1])
+    area_t = (tbox[..., 2] - tbox[..., 0]) * (tbox[..., 3] - tbox[..., 1])
+    inter = (torch.min(tbox[:, :, None, 2:], pbox[:, None, :, 2:]) -
+             torch.max(tbox[:, :, None, :2], pbox[:, None, :, :2])).clamp(0).prod(3)
+    pair_wise_iou = torch.where(valid, inter / (area_t[:, :, None] + area_p[:, None] - inter), torch.zeros_like(inter))
+    pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+
+    top_k, _ = torch.topk(pair_wise_iou, min(10, A), dim=2)
+    dynamic_ks = torch.clamp(top_k.sum(2).int(), min=1)  # (bs, G)
+
+    # One-hot BCE summed over classes = sum of the negative terms + (positive - negative) term of the target class
+    y = (p_cls.float().sigmoid() * p_obj.sigmoid()).sqrt()
+    logits = torch.log(y / (1 - y))
+    bce_neg = F.binary_cross_entropy_with_logits(logits, torch.zeros_like(logits), reduction="none")
+    bce_pos = F.binary_cross_entropy_with_logits(logits, torch.ones_like(logits), reduction="none")
+    bce_delta = (bce_pos - bce_neg)[cand_idx_]  # (bs, A, nc)
+    pair_wise_cls_loss = bce_neg.sum(1)[cand_idx_][:, None, :] + \
+        bce_delta.gather(2, t_cls[t_idx_][:, None, :].expand(-1, A, -1)).transpose(1, 2)
+
+    cost = (
+        pair_wise_cls_loss
+        + 3.0 * pair_wise_iou_loss
+    ).masked_fill(~valid, float('inf'))
+
+    # The dynamic_k lowest-cost candidates of every target from a single sort
+    _, rank = torch.sort(cost, dim=2, stable=True)
+    selected = torch.arange(A, device=device) < dynamic_ks[:, :, None]
+    matching_matrix = torch.zeros_like(cost).scatter_(2, rank, selected.to(cost.dtype)) * valid
+
+    # Candidates matched to several targets keep the cheapest one
+    anchor_matching_gt = matching_matrix.sum(1)  # (bs, A)
+    cost_argmin = F.one_hot(cost.argmin(1), G).transpose(1, 2).to(cost.dtype)  # (bs, G, A)
+    matching_matrix = torch.where((anchor_matching_gt > 1)[:, None, :], cost_argmin, matching_matrix)
+    fg_mask_inboxes = matching_matrix.sum(1) > 0.0
+    matched_gt_inds = matching_matrix.argmax(1)
+
+    b, a = fg_mask_inboxes.nonzero(as_tuple=True)
+    return cand_idx[b, a], t_idx[b, matched_gt_inds[b, a]]
+
+
 class ComputeLoss:
     # Compute losses
     def __init__(self, model, n_classes_lis,autobalance=False):
@@ -649,58 +716,12 @@ class ComputeLossOTA:
     def __call__(self, p, targets, imgs):  # predictions, targets, model   
         device = targets.device
         lcls, lbox, lobj = torch.zeros(n_att, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
-        #print("\nComputeLossOTA",targets.size(),targets[0])
-        
-        # Losses
-        #cls Losses
-        #print("\ntarget",targets.size())
-        for k in range(n_att):
-            #print("\ntarget.device",targets.device)
-            targets_att=torch.cat([targets[:,0:1],targets[:,k+1:k+2],targets[:,1+n_att:]],-1)
-            #print("\nhere",len(p[k]),p[k][0].size())
-            #print("\nhere",targets_att.size())
-            #print("\nComputeLossOTA before p_att",k,len(p[0]),p[0][0].size())
-            p_att=None
-            if k==0:
-                p_att=p[k]
-            else:
-                p_att=[torch.cat([p[0][i][...,:5],p[k][i]],-1) for i in range(len(p[0]))]
-
-            #print("\nComputeLossOTA before build_targets",k,len(p_att),p_att[0][0].size())
-            bs, as_, gjs, gis, targets_out, anchors = self.build_targets_BCE(p_att, targets_att, imgs,k)
-            '''
-            if k==0:
-                bs, as_, gjs, gis, targets_out, anchors = self.build_targets_BCE(p_att, targets_att, imgs,k)
-            else:
-                bs, as_, gjs, gis, targets_out, anchors = self.build_targets_CE(p_att, targets_att, imgs)
-            '''
-            for i, pi in enumerate(p_att):
-                b, a, gj, gi = bs[i], as_[i], gjs[i], gis[i]  # image, anchor, gridy, gridx
 
-                n = b.shape[0]  # number of targets
-                if n:
-                    ps = pi[b, a, gj, gi]  # prediction subset corresponding to targets
-
-                    # Classification
-                    selected_tcls = targets_out[i][:, 1].long()
-                    if self.n_classes_lis[k] > 1:  # cls loss (only if multiple classes)
-                        
-                        t = torch.full_like(ps[:, 5:], self.cn, device=device)  # targets
-                        t[range(n), selected_tcls] = self.cp
-                        
-                        #lcls[k] += self.CEcls[k](ps[:, 5:],selected_tcls.flatten())  # CE
-                        lcls[k] += self.BCEcls(ps[:, 5:], t)  # BCE
-                        '''
-                        if k!=0:
-                            lcls[k] += self.CEcls[k-1](ps[:, 5:], selected_tcls.flatten())  # CE
-                        else:
-                            lcls[k] += self.BCEcls(ps[:, 5:], t)  # BCE
-                        '''
-        
-        #other Losses
+        # SimOTA matching depends on the box head and its class only, so it runs once and its matches are
+        # reused to gather the class targets of every attribute head
         pre_gen_gains = [torch.tensor(pp.shape, device=device)[[3, 2, 3, 2]] for pp in p[0]] 
-        targets_att=torch.cat([targets[:,0:2],targets[:,1+n_att:]],-1)
-        bs, as_, gjs, gis, targets_out, anchors = self.build_targets_BCE(p[0], targets_att, imgs,0)
+        targets_att=torch.cat([targets[:,0:2],targets[:,1+n_att:]],-1)  # image, class, xywh
+        bs, as_, gjs, gis, targets_out, anchors, tinds = self.build_targets_BCE(p[0], targets_att, imgs)
         for i, pi in enumerate(p[0]):  # layer index, layer predictions
             b, a, gj, gi = bs[i], as_[i], gjs[i], gis[i]  # image, anchor, gridy, gridx
             tobj = torch.zeros_like(pi[..., 0], device=device)  # target obj
@@ -723,14 +744,14 @@ class ComputeLossOTA:
                 # Objectness
                 tobj[b, a, gj, gi] = (1.0 - self.gr) + self.gr * iou.detach().clamp(0).type(tobj.dtype)  # iou ratio
 
-                """
-                # Classification
-                selected_tcls = targets[i][:, 1].long()
-                if self.n_classes > 1:  # cls loss (only if multiple classes)
-                    t = torch.full_like(ps[:, 5:], self.cn, device=device)  # targets
-                    t[range(n), selected_tcls] = self.cp
-                    lcls += self.BCEcls(ps[:, 5:], t)  # BCE
-                """
+                # Classification, every head at the shared matches
+                for k in range(n_att):
+                    if self.n_classes_lis[k] > 1:  # cls loss (only if multiple classes)
+                        ps_cls = ps[:, 5:] if k == 0 else p[k][i][b, a, gj, gi]
+                        selected_tcls = targets[tinds[i], k+1].long()
+                        t = torch.full_like(ps_cls, self.cn, device=device)  # targets
+                        t[range(n), selected_tcls] = self.cp
+                        lcls[k] += self.BCEcls(ps_cls, t)  # BCE
 
                 # Append targets to text file
                 # with open('targets.txt', 'a') as file:
@@ -751,162 +772,65 @@ class ComputeLossOTA:
         loss = lbox + lobj + sum(lcls)
         return loss * bs, torch.cat((lbox, lobj, lcls, loss)).detach()
 
-    def build_targets_BCE(self, p, targets, imgs,k):
+    def build_targets_BCE(self, p, targets, imgs):
         
         #indices, anch = self.find_positive(p, targets)
         indices, anch = self.find_3_positive(p, targets)
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
-        device = torch.device(targets.device)
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
         nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
 
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
+        # Candidates of every image and layer, decoded at once
+        all_b, all_a, all_gj, all_gi, all_anch, from_which_layer = [], [], [], [], [], []
+        pxyxys, p_cls, p_obj = [], [], []
+        for i, pi in enumerate(p):
             
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append((torch.ones(size=(len(b),)) * i).to(device))
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
+            b, a, gj, gi = indices[i]
+            all_b.append(b)
+            all_a.append(a)
+            all_gj.append(gj)
+            all_gi.append(gi)
+            all_anch.append(anch[i])
+            from_which_layer.append(torch.full_like(b, i))
             
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.n_classes_lis[k])
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device=device)
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = (matching_matrix.sum(0) > 0.0).to(device)
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
+            fg_pred = pi[b, a, gj, gi]                
+            p_obj.append(fg_pred[:, 4:5])
+            p_cls.append(fg_pred[:, 5:])
+            
+            grid = torch.stack([gi, gj], dim=1)
+            pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
+            #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
+            pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i] * self.stride[i] #/ 8.
+            pxywh = torch.cat([pxy, pwh], dim=-1)
+            pxyxys.append(xywh2xyxy(pxywh))
+
+        all_b = torch.cat(all_b, dim=0)
+        all_a = torch.cat(all_a, dim=0)
+        all_gj = torch.cat(all_gj, dim=0)
+        all_gi = torch.cat(all_gi, dim=0)
+        all_anch = torch.cat(all_anch, dim=0)
+        from_which_layer = torch.cat(from_which_layer, dim=0)
+
+        txyxy = xywh2xyxy(targets[:, 2:6] * imgs.shape[2])
+        cand_inds, tinds = simota_assign(all_b, torch.cat(pxyxys, dim=0), torch.cat(p_obj, dim=0), torch.cat(p_cls, dim=0),
+                                         targets[:, 0].long(), txyxy, targets[:, 1].long(), p[0].shape[0])
+        from_which_layer = from_which_layer[cand_inds]
+
+        matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs = [], [], [], [], [], []
+        matching_tinds = []  # indices into targets
         for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:  #Wei
-                matching_bs[i] = torch.tensor([], device=device, dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device=device, dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device=device, dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device=device, dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device=device, dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device=device, dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
+            layer_idx = from_which_layer == i
+            layer_cands = cand_inds[layer_idx]
+            matching_bs.append(all_b[layer_cands])
+            matching_as.append(all_a[layer_cands])
+            matching_gjs.append(all_gj[layer_cands])
+            matching_gis.append(all_gi[layer_cands])
+            matching_targets.append(targets[tinds[layer_idx]])
+            matching_anchs.append(all_anch[layer_cands])
+            matching_tinds.append(tinds[layer_idx])
+
+        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs, matching_tinds
 
     def build_targets_CE(self, p, targets, imgs):
         
@@ -3,9 +3,11 @@
 import glob
 import math
 import os
+import queue
 import random
 from copy import copy
 from pathlib import Path
+from threading import Thread
 
 import cv2
 import matplotlib
@@ -14,11 +16,12 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import torch
+import torch.nn.functional as F
 import yaml
 from PIL import Image, ImageDraw, ImageFont
 from scipy.signal import butter, filtfilt
 
-from utils.general import xywh2xyxy, xyxy2xywh
+from utils.general import xywh2xyxy, xyxy2xywh, EvolveStore
 from utils.metrics import fitness
 
 # Settings
@@ -108,13 +111,9 @@ def plot_wh_methods():  # from utils.plots import *; plot_wh_methods()
 
 
 def output_to_target(output):
-    # Convert model output to target format [batch_id, class_id, x, y, w, h, conf]
-    targets = []
-    for i, o in enumerate(output):
-        for x1,y1,x2,y2, conf, *cls in o.cpu().numpy():
-            box=[x1,y1,x2,y2]
-            targets.append([i, *cls, *list(*xyxy2xywh(np.array(box)[None])), conf])
-    return np.array(targets)
+    # Convert model output to target format [batch_id, class_ids, x, y, w, h, conf], a tensor on the output device
+    targets = [torch.cat((torch.full_like(o[:, :1], i), o[:, 5:], xyxy2xywh(o[:, :4]), o[:, 4:5]), 1) for i, o in enumerate(output)]
+    return torch.cat(targets, 0) if targets else torch.zeros((0, 6 + n_att))
 
 
 def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max_size=640, max_subplots=16):
@@ -126,7 +125,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
         targets = targets.cpu().numpy()
 
     # un-normalise
-    if np.max(images[0]) <= 1:
+    if images.dtype != np.uint8 and np.max(images[0]) <= 1:
         images *= 255
 
     tl = 3  # line thickness
@@ -196,6 +195,103 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
     return mosaic
 
 
+class ImagePlotter:
+    # Renders plot_images() mosaics in one background thread, dropping the work when maxsize mosaics are pending. The
+    # queue holds uint8 thumbnails (downscaled to max_size) of the plotted images only. For CUDA inputs the thumbnails
+    # are made on device and copied with the targets to pinned memory without blocking, the thread waits for the copy.
+    # CPU inputs are processed in the thread and must not be modified in place afterwards
+    def __init__(self, maxsize=4, max_size=640, max_subplots=16):
+        self.queue = queue.Queue(maxsize)
+        self.max_size, self.max_subplots = max_size, max_subplots
+        self.thread = None
+
+    def __call__(self, images, targets, paths=None, fname='images.jpg', names=None, normalized=True):
+        # Queue a plot_images() call of images in 0.0 - 1.0 (normalized) or 0 - 255, returns False if dropped
+        if self.queue.full():
+            return False
+        images = images[:self.max_subplots].detach()
+        shape, event = images.shape[2:], None
+        if images.is_cuda:
+            images = self.to_host(self.thumbnails(images, normalized))
+            if isinstance(targets, torch.Tensor):
+                targets = self.to_host(targets.detach())
+            event = torch.cuda.Event()
+            event.record()
+
+        try:
+            self.queue.put_nowait((images, targets, shape, normalized, event, paths, fname, names))
+        except queue.Full:
+            return False
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return True
+
+    @staticmethod
+    def to_host(x):
+        # Device to pinned host copy, complete once the current stream reaches it
+        if not x.is_cuda:
+            return x
+        y = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        y.copy_(x, non_blocking=True)
+        return y
+
+    def thumbnails(self, images, normalized):
+        # Images as uint8 downscaled to max_size
+        h, w = images.shape[2:]
+        f = self.max_size / max(h, w)
+        if f < 1:
+            images = F.interpolate(images.float(), size=(math.ceil(f * h), math.ceil(f * w)), mode='bilinear',
+                                   align_corners=False)
+        if images.dtype != torch.uint8:
+            images = images.float()
+            images = (images * 255 if normalized else images).clamp(0, 255).to(torch.uint8)  # un-normalise
+        return images
+
+    def scale_targets(self, targets, n, shape):
+        # Targets of the first n images, absolute boxes scaled to the thumbnails
+        if isinstance(targets, torch.Tensor):
+            targets = targets.numpy()
+        targets = targets[targets[:, 0] < n] if len(targets) else targets
+        f = self.max_size / max(shape)
+        if f < 1 and len(targets):
+            targets = targets.copy()
+            for i in range(n):  # absolute boxes scale with the image
+                j = targets[:, 0] == i
+                if j.any() and xywh2xyxy(targets[j, 1+n_att:5+n_att]).max() > 1.01:
+                    targets[j, 1+n_att:5+n_att] *= f
+        return targets
+
+    def run(self):
+        while True:
+            x = self.queue.get()
+            try:
+                if x is None:
+                    return
+                images, targets, shape, normalized, event, *args = x
+                if event is not None:
+                    event.synchronize()
+                else:
+                    images = self.thumbnails(images, normalized)
+                targets = self.scale_targets(targets, len(images), shape)
+                plot_images(images.numpy(), targets, *args, max_size=self.max_size, max_subplots=self.max_subplots)
+            except Exception as e:
+                print(f'WARNING: plot_images failure: {e}')
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        # Block until the queued mosaics are saved
+        self.queue.join()
+
+    def close(self):
+        self.join()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
 def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
     # Plot LR simulating training for full epochs
     optimizer, scheduler = copy(optimizer), copy(scheduler)  # do not modify originals
@@ -324,11 +420,12 @@ def plot_labels(labels, names=(), save_dir=Path(''), loggers=None):
             v.log({"Labels": [v.Image(str(x), caption=x.name) for x in save_dir.glob('*labels*.jpg')]}, commit=False)
 
 
-def plot_evolution(yaml_file='data/hyp.finetune.yaml'):  # from utils.plots import *; plot_evolution()
-    # Plot hyperparameter evolution results in evolve.txt
+def plot_evolution(yaml_file='data/hyp.finetune.yaml', evolve_file='evolve.txt'):
+    # Plot hyperparameter evolution results in evolve.txt, rows of older formats NaN-padded. from utils.plots import *
     with open(yaml_file,encoding='UTF-8') as f:
         hyp = yaml.load(f, Loader=yaml.SafeLoader)
-    x = np.loadtxt('evolve.txt', ndmin=2)
+    x = EvolveStore(evolve_file).read()
+    x = np.pad(x, ((0, 0), (0, max(7 + len(hyp) - x.shape[1], 0))), constant_values=np.nan)
     f = fitness(x)
     # weights = (f - f.min()) ** 2  # for weighted results
     plt.figure(figsize=(10, 12), tight_layout=True)
@@ -336,10 +433,12 @@ def plot_evolution(yaml_file='data/hyp.finetune.yaml'):  # from utils.plots impo
     for i, (k, v) in enumerate(hyp.items()):
         y = x[:, i + 7]
         # mu = (y * weights).sum() / weights.sum()  # best weighted result
-        mu = y[f.argmax()]  # best single result
-        plt.subplot(6, 5, i + 1)
-        plt.scatter(y, f, c=hist2d(y, f, 20), cmap='viridis', alpha=.8, edgecolors='none')
-        plt.plot(mu, f.max(), 'k+', markersize=15)
+        mu = y[np.nanargmax(f)]  # best single result
+        plt.subplot(math.ceil(len(hyp) / 5), 5, i + 1)
+        j = ~np.isnan(y) & ~np.isnan(f)  # rows that recorded k
+        if j.any():
+            plt.scatter(y[j], f[j], c=hist2d(y[j], f[j], 20), cmap='viridis', alpha=.8, edgecolors='none')
+        plt.plot(mu, np.nanmax(f), 'k+', markersize=15)
         plt.title('%s = %.3g' % (k, mu), fontdict={'size': 9})  # limit to 40 characters
         if i % 5 != 0:
             plt.yticks([])
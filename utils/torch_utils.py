@@ -5,11 +5,13 @@ import logging
 import math
 import os
 import platform
+import shutil
 import subprocess
 import time
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
+from threading import Thread
 
 import torch
 import torch.backends.cudnn as cudnn
@@ -328,6 +330,120 @@ class ModelEMA:
         copy_attr(self.ema, model, include, exclude)
 
 
+def host_copy(x, half=False):
+    # Copy the tensors of a (nested) state to CPU, device tensors go to pinned memory without waiting for the device
+    if isinstance(x, torch.Tensor):
+        y = torch.empty(x.shape, dtype=torch.half if half and x.is_floating_point() else x.dtype, pin_memory=x.is_cuda)
+        return y.copy_(x.detach(), non_blocking=x.is_cuda)
+    if isinstance(x, dict):
+        return type(x)((k, host_copy(v, half)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(host_copy(v, half) for v in x)
+    return x
+
+
+def host_module(model, half=True):
+    # deepcopy(model).half() with parameters and buffers copied straight to (pinned) CPU memory, no device copy is made
+    memo = {id(p): nn.Parameter(host_copy(p, half), requires_grad=p.requires_grad) for p in model.parameters()}
+    memo.update({id(b): host_copy(b, half) for b in model.buffers()})
+    return deepcopy(model, memo)
+
+
+class InputStager:
+    # Moves uint8 image batches (numpy arrays or CPU tensors) to the device as dtype inputs scaled to 0-1. On CUDA the
+    # batch is uploaded with non_blocking=True on a side stream, so it overlaps the work still queued for the previous
+    # batch, into one of n persistent uint8 device buffers. Pageable inputs are staged through n persistent pinned
+    # buffers first, pinned ones (pin_memory DataLoader, BatchBuffers) are uploaded directly. One division on the
+    # current stream then converts and scales. On CPU the input is used without a copy, converted and divided in place
+    # (mixed-dtype division is slower than the two passes there)
+    def __init__(self, device, half=False, n=2):
+        self.device = torch.device(device)
+        self.dtype = torch.half if half else torch.float
+        self.n, self.i = n, 0
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)  # uploads
+            self.host, self.buffers = [None] * n, [None] * n  # pinned staging and device uint8 buffers
+            self.uploaded = [torch.cuda.Event() for _ in range(n)]  # upload into a buffer done
+            self.released = [torch.cuda.Event() for _ in range(n)]  # work queued on a buffer's batch done
+
+    def __call__(self, x, normalize=True):
+        # Device tensor of x, x / 255 in dtype if normalize. A uint8 result (normalize=False) is valid until n calls
+        # later, when its buffer is reused
+        borrowed = not isinstance(x, torch.Tensor)  # numpy memory the caller may refill as soon as this returns
+        x = torch.from_numpy(x) if borrowed else x
+        if self.device.type != 'cuda':
+            return x.to(self.dtype, copy=True).div_(255) if normalize else x
+
+        i, current = self.i, torch.cuda.current_stream(self.device)
+        self.i = (i + 1) % self.n
+        self.released[i - 1].record(current)  # all work on the previous batch is queued before this point
+        size = x.numel()
+        pinned = x.is_pinned()
+        if pinned:
+            src = x
+        else:
+            self.uploaded[i].synchronize()  # the staging buffer was uploaded n calls ago
+            if self.host[i] is None or self.host[i].numel() < size:
+                self.host[i] = torch.empty(size, dtype=x.dtype, pin_memory=True)
+            src = self.host[i][:size].view(x.shape).copy_(x)
+        if self.buffers[i] is None or self.buffers[i].numel() < size:  # (re)allocated on the current stream
+            self.buffers[i] = torch.empty(size, dtype=x.dtype, device=self.device)
+        y = self.buffers[i][:size].view(x.shape)
+        with torch.cuda.stream(self.stream):
+            self.stream.wait_event(self.released[i])  # the batch n calls ago is done with the buffer
+            y.copy_(src, non_blocking=True)
+            self.uploaded[i].record(self.stream)
+        if pinned and borrowed:
+            self.uploaded[i].synchronize()
+        current.wait_event(self.uploaded[i])
+        return torch.div(y, 255, out=torch.empty(x.shape, dtype=self.dtype, device=self.device)) if normalize else y
+
+
+class CheckpointWriter:
+    # Writes checkpoints in a background thread while training continues, save() snapshots the checkpoint once into
+    # (pinned) CPU memory with modules as FP16 copies, the thread serializes it once into a temporary file, renames it
+    # into the first path and hard-links (or copies) it atomically to the other paths
+    def __init__(self):
+        self.thread, self.error = None, None
+
+    def save(self, ckpt, paths):
+        self.wait()  # one checkpoint in flight
+        ckpt = {k: host_module(v) if isinstance(v, nn.Module) else host_copy(v) for k, v in ckpt.items()}
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()  # after the copies
+        self.thread = Thread(target=self.write, args=(ckpt, [Path(p) for p in paths], event))
+        self.thread.start()
+
+    def write(self, ckpt, paths, event=None):
+        try:
+            if event is not None:
+                event.synchronize()
+            tmp = paths[0].with_suffix('.tmp')
+            torch.save(ckpt, tmp)
+            os.replace(tmp, paths[0])
+            for f in paths[1:]:
+                tmp = f.with_suffix('.tmp')
+                tmp.unlink(missing_ok=True)
+                try:
+                    os.link(paths[0], tmp)
+                except OSError:  # no hard links on this file system
+                    shutil.copyfile(paths[0], tmp)
+                os.replace(tmp, f)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        # Block until the pending checkpoint is written, raises its error if any
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+
 class BatchNormXd(torch.nn.modules.batchnorm._BatchNorm):
     def _check_input_dim(self, input):
         # The only difference between BatchNorm1d, BatchNorm2d, BatchNorm3d, etc